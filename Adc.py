@@ -0,0 +1,94 @@
+from Scheduler import PropagatingThread
+from nested_lookup import get_all_keys, nested_update
+import time
+import os
+
+class AdcChannel():
+    """ Trophy ADC input in sysfs, read with pread on a file descriptor held open between reads. """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fd = None
+        self.warned = False
+
+    def read(self):
+        if self.fd is None: self.fd = os.open(self.fname, os.O_RDONLY)
+        return int(os.pread(self.fd, 32, 0))
+
+    def sample(self, n=1):
+        """ Mean of n consecutive readings, or 0 if the ADC cannot be read. """
+
+        try: vals = [self.read() for _ in range(n)]
+        except (OSError, ValueError) as e:
+            if not self.warned: print('[ADC] Cannot read %s: %s' % (self.fname, e))
+            self.warned = True
+            self.close()
+            return 0
+        return vals[0] if n == 1 else sum(vals) / n
+
+    def close(self):
+        if self.fd is not None: os.close(self.fd)
+        self.fd = None
+
+class AdcMeasurement():
+    """
+    Measure probeDC or CalibDAC levels of every ROC and half with the Trophy ADCs.
+    Both halves of a chip and all chips of a sector share one ADC, so a step enables the ReferenceVoltage
+    half of at most one ROC per sector. Sectors are read concurrently, and a step only writes the register
+    deltas that switch the previous ROCs/half off and the next ones on.
+    """
+
+    def __init__(self, board, cfgs, channels, samples=1, settle=0.):
+        self.board = board
+        self.samples = samples      # ADC readings averaged per measurement
+        self.settle = settle        # seconds to wait after configuring a step
+        cfg_keys = get_all_keys(cfgs)    # scan the received cfg for 'Calib_dac' or 'Probe_dcX'
+        if 'Calib_dac' in cfg_keys:
+            self.adcs = channels['cal']
+            keys = ['IntCtest', 'ExtCtest', 'Calib_dac']
+        elif any('Probe_dc' in str(key) for key in cfg_keys):
+            self.adcs = channels['pdc']
+            keys = [key for key in cfg_keys if 'Probe_dc' in str(key)]
+        else: raise ValueError('read_adc needs Calib_dac or Probe_dc parameters.')
+
+        # expand original cfgs (ocfgs) and zero'd cfgs (zcfgs)
+        self.ocfgs = board.translator.expand_cfgs(cfgs, board.rocs)
+        self.zcfgs = self.ocfgs
+        for key in keys: self.zcfgs = nested_update(self.zcfgs, key=key, value=0)
+
+    def run(self):
+        translator = self.board.translator
+        half_delta = lambda cfgs, roc, half: translator.compile_cfg({'ReferenceVoltage': {half: cfgs[roc]['ReferenceVoltage'][half]}})
+        self.board.configure(self.zcfgs)
+
+        res = {}
+        prev = {}     # roc -> delta switching its measured half off again
+        for half in [0, 1]:
+            for slot in self.__slots(half):
+                deltas = {roc: [delta] for roc, delta in prev.items()}
+                for roc in slot: deltas.setdefault(roc, []).append(half_delta(self.ocfgs, roc, half))
+                self.board.apply(deltas)
+                if self.settle: time.sleep(self.settle)
+                for roc, val in self.__read(slot).items(): res.setdefault(roc, {})[half] = val
+                prev = {roc: half_delta(self.zcfgs, roc, half) for roc in slot}
+        if prev: self.board.apply({roc: [delta] for roc, delta in prev.items()})   # deconfigure
+        return res
+
+    def __slots(self, half):
+        """ Groups of ROCs measured together: the n-th ROC (with this half configured) of every sector. """
+
+        sectors = {}
+        for roc in sorted(self.ocfgs):
+            if half in self.ocfgs[roc].get('ReferenceVoltage', {}): sectors.setdefault(roc[:6], []).append(roc)
+        return [[rocs[idx] for rocs in sectors.values() if idx < len(rocs)]
+                for idx in range(max([len(rocs) for rocs in sectors.values()] or [0]))]
+
+    def __read(self, slot):
+        """ Read the sector ADCs of a slot concurrently. """
+
+        res = {}
+        def read(roc): res[roc] = self.adcs[roc[:6]].sample(self.samples)
+        threads = [PropagatingThread(target=read, args=(roc,)) for roc in slot]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return res
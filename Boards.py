@@ -1,66 +1,132 @@
 from ROC import ROC
 from Translator import Translator
+from RegMap import RegMap
+from State import BoardState
 from nested_dict import nested_dict
-from nested_lookup import get_all_keys, nested_update
-from threading import Thread
-from itertools import groupby
-
-class PropagatingThread(Thread):
-    """ Thread class to propagate occuring Exceptions to the calling thread. """
-
-    def run(self):
-        self.exc = None
-        try: self.ret = self._target(*self._args, **self._kwargs)
-        except BaseException as e: self.exc = e     # store exception
-
-    def join(self):
-        super(PropagatingThread, self).join()
-        if self.exc: raise self.exc
-        return self.ret
+from Scheduler import BusScheduler
+from Scan import Scan
+from Stats import stats
+from Adc import AdcChannel, AdcMeasurement
+import numpy as np
+import random
 
 class CharBoard():
     """ Base class for characterization boards """
 
-    def __init__(self, links):
-        self.rocs = {name:ROC(link) for (name, link) in links.items()}
+    def __init__(self, links, state=None):
+        self.rocs = {name:ROC(link, name=name) for (name, link) in links.items()}
         self.writeCaches = {name:{} for name in links.keys()}  # dicts are thread-safe, so we can write to it from different threads
-        for rname, roc in self.rocs.items(): 
-            roc.reset()
-            print('[%s] GPIO reset' % rname)
-        roc_type = self.__detect_roc_type()         # Determine which ROC architecture we're on.
+        self.elided = {name:0 for name in links.keys()}        # writes skipped by last configure, since registers were unchanged
+        self.max_retries = 3                                    # recovery attempts per configure before giving up
+        self.unrecovered = set()                                # ROCs left reset by a failed recovery: cache replayed on next apply
+        self.state = BoardState(state, links.keys()) if state else None    # register snapshot directory for warm starts
+        snapshot = self.state.load() if self.state else None
+        if snapshot and self.__adopt(*snapshot):    # chips still hold the snapshot: no reset, no reconfigure
+            roc_type = snapshot[0]
+        else:
+            self.reset()
+            roc_type = self.__detect_roc_type()     # Determine which ROC architecture we're on.
+            if self.state: self.state.create(roc_type)
         self.translator = Translator(roc_type)      
+        for roc in self.rocs.values():              # Shadow registers are then read lazily per page.
+            roc.set_layout(self.translator.regMap.addr_keys())
+        self.scheduler = BusScheduler(self.rocs)
 
-    def configure(self, cfgs):
-        """ Configure ROCs in separate threads and return after all are finished. """
+    def configure(self, cfgs, force=False):
+        """
+        Configure ROCs with one worker per I2C bus and return after all are finished.
+        Configs are translated up front; the per-ROC merge with its register state runs in the bus workers.
+        Only registers whose value differs from the known register state are written, unless force is set.
+        """
 
-        threads = []
-        for lbl, cfg in cfgs.items():
+        deltas = {}
+        for lbl, cfg in cfgs.items():       # once per label, shared by all ROCs it matches
+            with stats.span('translate.compile_us'): delta = self.translator.compile_cfg(cfg)
             for rname in [name for name in self.rocs.keys() if lbl in name]:
-                roc = self.rocs[rname]
-                thread = PropagatingThread(target=self.__write, args=(roc, rname, cfg))
-                thread.start()
-                threads.append(thread)
-        for thread in threads:
-            try: 
-                thread.join()                       # wait for threads to finish
-            except Exception as e:                  # catch i2c exceptions.
-                print("ERROR in configure: ", e)
-                for rname, roc in self.rocs.items(): 
-                    print('[%s] GPIO reset' % rname)
-                    roc.reset()
-                for lbl, roc in self.rocs.items(): 
-                    sortedPairs = self.translator.sort_pairs(self.writeCaches[lbl])
-                    roc.write(sortedPairs)                                                      # Rewrite caches
-                return self.configure(cfgs)                                                     # Reload cfgs
+                deltas.setdefault(rname, []).append(delta)
+        return self.apply(deltas, force)
+
+    def scan(self, spec, progress=None):
+        """ Run a parameter sweep on the board (see Scan). progress(step result) is called after each step. """
+
+        return Scan(self, spec).run(progress)
+
+    def write_regs(self, regs, force=False):
+        """ Write register-level {roc_name: {(R0,R1): val}} pairs, skipping the parameter translation. """
+
+        return self.apply({rname: [pairs] for rname, pairs in regs.items()}, force)
+
+    def read_regs(self, regs=None):
+        """ Read register-level {roc_name: {(R0,R1): val}} pairs. Without regs, dump all configured registers. """
+
+        if not regs: regs = self.writeCaches
+        return {rname: self.rocs[rname].read(self.translator.sort_pairs(pairs)) for rname, pairs in regs.items()}
+
+    def apply(self, deltas, force=False):
+        """
+        Write {roc_name: [deltas]} with one worker per I2C bus. A delta is a compiled config or addr:val pairs.
+        ROCs that fail are reset on their own (together with ROCs sharing their reset lines), get their cached
+        state replayed and resume their deltas, while the other ROCs are left alone. Gives up after max_retries;
+        ROCs still failing then get their whole cached state replayed by the next apply.
+        """
+
+        plans = {}      # burst plans shared by ROCs receiving the same delta
+        self.elided = {name:0 for name in self.rocs.keys()}
+        deltas = dict(deltas)
+        for rname in self.unrecovered:      # chips at reset defaults: restore their whole cached state first
+            deltas[rname] = [dict(self.writeCaches[rname])] + deltas.get(rname, [])
+        tasks = {rname: self.__write(self.rocs[rname], rname, rdeltas, force, plans) for rname, rdeltas in deltas.items()}
+        failures = self.scheduler.run(tasks)
+        for attempt in range(self.max_retries):
+            if not failures: break
+            print("ERROR in configure: ", failures)    # catch i2c exceptions.
+            tasks = {}
+            for rname in self.reset(list(failures)):
+                replay = dict(self.writeCaches[rname])  # includes the pairs of an interrupted delta
+                self.elided[rname] = 0                  # counted again by the replay
+                tasks[rname] = self.__write(self.rocs[rname], rname, [replay] + deltas.get(rname, []), force, plans)
+            failures = self.scheduler.run(tasks)
+        self.unrecovered = set(failures)
+        if self.state:
+            for rname in failures: self.state.clear(rname)     # a warm start must not adopt a reset chip
+            self.state.flush()
+        if failures:
+            raise Exception('ROC(s) %s failed after %d recovery attempts: %s. Their cached configuration is replayed on the next configure.'
+                            % (sorted(failures), self.max_retries, failures))
 
         return "ROC(s) CONFIGURED"
 
+    def reset(self, rnames=None):
+        """
+        GPIO-reset ROCs (default: all) with one coordinated pulse over all their reset lines.
+        ROCs sharing reset lines (HD HexaBoard sectors) are reset together. Return the reset ROC names.
+        """
+
+        gpios = []
+        for rname in rnames or self.rocs.keys():
+            if self.rocs[rname].link.gpio not in gpios: gpios.append(self.rocs[rname].link.gpio)
+        type(gpios[0]).write_all(gpios, 0)
+        type(gpios[0]).write_all(gpios, 1)
+        reset = [rname for rname, roc in self.rocs.items() if roc.link.gpio in gpios]
+        for rname in reset:
+            self.rocs[rname].invalidate()
+            print('[%s] GPIO reset' % rname)
+        return reset
+
     def read(self, cfgs):
         """ Factory method for unified interface to write. """
 
         if cfgs: return self.__read_fr_cfgs(cfgs)
         else: return self.__read_fr_cache()
 
+    def retry_stats(self, top=10):
+        """ I2C retries and I2C state machine resets per ROC, with the registers failing most often. """
+
+        counts = {rname: roc.retry_counts() for rname, roc in self.rocs.items()}
+        return {rname: {'retries': sum(counts[rname].values()), 'escalations': roc.escalations,
+                        'registers': {'%d,%d' % addr: n for addr, n in counts[rname].most_common(top)}}
+                for rname, roc in self.rocs.items()}
+
     def reset_tdc(self):
         """ Reset MasterTDC parameter for all ROCs. """
 
@@ -68,14 +134,37 @@ class CharBoard():
         self.configure({lbl:{"MasterTdc":{"all":{"START_COUNTER":1}}} for lbl in self.rocs.keys()})
         return "masterTDCs reset."
 
-    def __write(self, roc, roc_name, cfg):
-        """ Stuff that should run in a separate thread per ROC. """
+    def __write(self, roc, roc_name, deltas, force=False, plans=None):
+        """
+        Yield the write groups of a ROC's deltas; consumed by the ROC's bus worker.
+        ROCs whose merged delta leaves the same registers to write share one burst plan through plans.
+        """
 
-        pairs = self.translator.pairs_from_cfg(cfg, self.writeCaches[roc_name], roc)
-        self.writeCaches[roc_name].update(pairs)
-        sortedPairs = self.translator.sort_pairs(pairs)
-        roc.write(sortedPairs)
-        print('[%s] Configured' % roc_name)
+        for delta in deltas:
+            key = None
+            with stats.span('translate.merge_us'):
+                if isinstance(delta, dict):
+                    pairs = delta
+                    dirty = pairs if force else roc.changed(pairs)
+                else:
+                    addrs, vals = self.translator.merge_delta(delta, roc)
+                    mask = np.ones(len(addrs), dtype=bool) if force else roc.changed_mask(addrs, vals)
+                    pairs = dict(zip(zip((addrs & 0xff).tolist(), (addrs >> 8).tolist()), vals.tolist()))
+                    dirty = {addr: pairs[addr] for addr in zip((addrs[mask] & 0xff).tolist(), (addrs[mask] >> 8).tolist())}
+                    key = (roc.combined, addrs[mask].tobytes(), vals[mask].tobytes())
+            self.writeCaches[roc_name].update(pairs)
+            elided = len(pairs) - len(dirty)
+            self.elided[roc_name] += elided
+            stats.count('writes.dirty', len(dirty))
+            stats.count('writes.elided', elided)
+            plan = plans.get(key) if plans is not None and key is not None else None
+            if plan is not None and plan.fits(roc): stats.count('plan.shared')
+            else:
+                with stats.span('plan_us'): plan = self.translator.planner.plan(dirty, roc)
+                if plans is not None and key is not None: plans[key] = plan
+            for group in plan.groups: yield group
+            if self.state: self.state.update(roc_name, pairs)
+            print('[%s] Configured (%d written, %d unchanged, ~%d transactions)' % (roc_name, len(dirty), elided, plan.transactions))
 
     def __read_fr_cache(self):
         """ Read addresses in write_param cache from rocs. """
@@ -95,9 +184,9 @@ class CharBoard():
         rd_cfgs = {}
         for lbl, cfg in cfgs.items():
             for roc_name in [name for name in self.rocs.keys() if lbl in name]:
-                roc = self.rocs[rname]
+                roc = self.rocs[roc_name]
                 req_keys = set(key[-1] for key in nested_dict(cfg).keys_flat())
-                pairs = self.translator.pairs_from_cfg(cfg, roc_name)
+                pairs = self.translator.pairs_from_cfg(cfg, roc)
                 sortedPairs = self.translator.sort_pairs(pairs)
                 rd_pairs = roc.read(sortedPairs)
                 rd_cfg = self.translator.cfg_from_pairs(rd_pairs)	# params in same reg are also read..
@@ -108,6 +197,32 @@ class CharBoard():
                 rd_cfgs[roc_name] = req_cfg.to_dict()
         return rd_cfgs
 
+    def __adopt(self, roc_type, caches, nsample=32):
+        """
+        Adopt the ROCs in their snapshot state if a sample of their configured registers reads back unchanged.
+        Registers differing from their reset default are sampled first, so that power-cycled chips are noticed.
+        """
+
+        defaults = RegMap(roc_type).defaults()
+        try:
+            for rname, pairs in caches.items():
+                if not pairs: return False
+                addrs = [addr for addr, val in pairs.items() if val != defaults[addr[1], addr[0]]] or list(pairs.keys())
+                sample = random.sample(addrs, min(nsample, len(addrs)))
+                keys = np.array([(r1 << 8) | r0 for r0, r1 in sample], dtype=np.int64)
+                rd_pairs = self.rocs[rname].read(self.rocs[rname].group_keys(keys))
+                if any(rd_pairs[addr] != pairs[addr] for addr in sample):
+                    print('[%s] Chip differs from snapshot, resetting' % rname)
+                    return False
+        except IOError as e:
+            print('[STATE] Cannot verify snapshot: %s' % e)
+            return False
+        for rname, pairs in caches.items():
+            self.writeCaches[rname] = pairs
+            self.rocs[rname].assume(pairs)
+            print('[%s] Adopted from snapshot (%d registers)' % (rname, len(pairs)))
+        return True
+
     def __detect_roc_type(self):
         """ Query ROCs to detect if we're on Si or SiPM. """
 
@@ -131,69 +246,46 @@ class HexaBoard(CharBoard):
     2. On-board Trophy ADCs
     """
 
+    pwr_adc = {'piv_a': '/sys/class/i2c-dev/i2c-1/device/1-0049/in4_input',
+               'piv_d': '/sys/class/i2c-dev/i2c-1/device/1-0049/in5_input'}
+
+    pdc_adc = {'roc_s0': '/sys/class/i2c-dev/i2c-2/device/2-0048/in5_input',
+               'roc_s1': '/sys/class/i2c-dev/i2c-3/device/3-0049/in5_input',
+               'roc_s2': '/sys/class/i2c-dev/i2c-1/device/1-0048/in5_input', }
+
+    cal_adc = {'roc_s0': '/sys/class/i2c-dev/i2c-2/device/2-0048/in4_input',
+               'roc_s1': '/sys/class/i2c-dev/i2c-3/device/3-0049/in4_input',
+               'roc_s2': '/sys/class/i2c-dev/i2c-1/device/1-0048/in4_input', }
+
+    def __init__(self, links, state=None):
+        super(HexaBoard, self).__init__(links, state)
+        self.adcs = {kind: {lbl: AdcChannel(fname) for lbl, fname in adc.items()}
+                     for kind, adc in [('pwr', self.pwr_adc), ('pdc', self.pdc_adc), ('cal', self.cal_adc)]}
+        self.adc_samples = 1        # readings averaged per read_adc measurement
+        self.adc_settle = 0.        # seconds between configuring and reading the ADCs
+
+    def monitor_adcs(self):
+        """ All Trophy ADC inputs {name: sysfs file} for the background Monitor. """
+
+        adcs = dict(self.pwr_adc)
+        for kind, adc in [('pdc', self.pdc_adc), ('cal', self.cal_adc)]:
+            adcs.update({'%s_%s' % (kind, sector): fname for sector, fname in adc.items()})
+        return adcs
+
     def read_pwr(self):
         """ Return reading of TrophyBoard's analog (piv_a) and digital (piv_d) ADCs. """
 
-        adc = { 'piv_a': '/sys/class/i2c-dev/i2c-1/device/1-0049/in4_input' ,
-                'piv_d': '/sys/class/i2c-dev/i2c-1/device/1-0049/in5_input' }
-        res = {}
-        for lbl, cmd in adc.items():
-            with open(cmd) as f:
-                res[lbl] = f.read().rstrip('\n')
-        return res
+        return {lbl: adc.sample() for lbl, adc in self.adcs['pwr'].items()}
 
     def read_adc(self, cfgs):
         """
-        Return reading of TrophyBoard's probeDC and InCtest ADCs.
+        Return reading of TrophyBoard's probeDC and InCtest ADCs per ROC and half (see Adc.AdcMeasurement).
         Since both halves of a chip and all the chips in a sector are wired together for one ADC,
-        we have to set and read probeDC and calibDAC sequentially per chip and per half.
-        Orientation of HexaBoard determines which ADC (in TrophyBoard sectors) have to be read.
+        we have to set and read probeDC and calibDAC sequentially per chip and per half; sectors are read in parallel.
+        An optional top-level 'adc': {'samples': N, 'settle': seconds} overrides averaging and settle time.
         """
 
-        pdc_adc = {'roc_s0': '/sys/class/i2c-dev/i2c-2/device/2-0048/in5_input',
-                   'roc_s1': '/sys/class/i2c-dev/i2c-3/device/3-0049/in5_input',
-                   'roc_s2': '/sys/class/i2c-dev/i2c-1/device/1-0048/in5_input', }
-
-        cal_adc = {'roc_s0': '/sys/class/i2c-dev/i2c-2/device/2-0048/in4_input',
-                   'roc_s1': '/sys/class/i2c-dev/i2c-3/device/3-0049/in4_input',
-                   'roc_s2': '/sys/class/i2c-dev/i2c-1/device/1-0048/in4_input', }
-
-        sectors = self.__get_sectorNames()
-        cfg_keys = get_all_keys(cfgs)    # scan the received cfg for 'Calib_dac' or 'Probe_dcX'
-        if 'Calib_dac' in cfg_keys: 
-            adc  = cal_adc
-            keys = ['IntCtest', 'ExtCtest', 'Calib_dac']
-        elif any('Probe_dc' in str(key) for key in cfg_keys): 
-            adc  = pdc_adc
-            keys = [key for key in cfg_keys if 'Probe_dc' in key]
-
-        # expand original cfgs (ocfgs) and zero'd cfgs (zcfgs)
-        res = nested_dict()
-        ocfgs = self.translator.expand_cfgs(cfgs, self.rocs)
-        zcfgs = ocfgs.copy()
-        for key in keys: zcfgs = nested_update(zcfgs, key=key, value=0)
-        
-        # group ROCs that can be configured in parallel
-        rocs = sorted(list(ocfgs.keys()), key=lambda roc: roc[-1])
-        confGroup = [list(g) for _, g in groupby(rocs, key=lambda roc: roc[-1])]
-
-        for sel_half in [0,1]:
-            for group in confGroup:
-                # create cfgs for ROCs and Halves that can be configured together
-                ncfgs = nested_dict(zcfgs)
-                for roc in group:
-                    ncfgs[roc]['ReferenceVoltage'][sel_half] = ocfgs[roc]['ReferenceVoltage'][sel_half]
-
-                # configure, readout & save
-                self.configure(ncfgs.to_dict())
-                for roc in group:
-                    sector = self.sector_map[roc]
-                    try:
-                        with open(adc[sector]) as f:
-                            res[roc][sel_half] = f.read().rstrip('\n')
-                    except:
-                        res[roc][sel_half] = 0
-                        continue
-
-        self.configure(zcfgs)   # deconfigure
-        return res.to_dict()
+        cfgs = dict(cfgs)
+        opts = cfgs.pop('adc', None) or {}
+        return AdcMeasurement(self, cfgs, self.adcs, opts.get('samples', self.adc_samples),
+                              opts.get('settle', self.adc_settle)).run()
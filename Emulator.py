@@ -0,0 +1,114 @@
+from Link import i2c, gpio, i2c_char_map, i2c_ld_map, i2c_hd_map
+from RegMap import RegMap
+from threading import Lock
+import random
+import time
+
+"""
+In-memory emulation of HGCROC boards, to run the full server stack without hardware (e.g. for benchmarks).
+Chips implement the I2C register protocol used by ROC: R0/R1 hold the register address,
+R2 reads/writes the addressed register and R3 does so with post-increment of R0.
+"""
+
+emu_topologies = {'char': (i2c_char_map, [(0x28, 0)]),
+                  'ld':   (i2c_ld_map, [(0x00, 0), (0x40, 1), (0x20, 2)]),
+                  'hd':   (i2c_hd_map, [(0x08, 0), (0x10, 0), (0x18, 1), (0x20, 1), (0x28, 2), (0x30, 2)])}
+
+class EmuChip():
+    """ Register file and address registers of one emulated ROC. """
+
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.reset()
+
+    def reset(self):
+        self.regs = self.defaults.copy()
+        self.reset_i2c()
+
+    def reset_i2c(self):
+        self.R = [0, 0]
+
+    def op(self, op):
+        """ Execute one ('w', offset, byte) or ('r', offset) op and return the read byte (else None). """
+
+        offset = op[1]
+        if offset in (0, 1):
+            if op[0] == 'w': self.R[offset] = op[2]
+            else: return self.R[offset]
+            return None
+        r0, r1 = self.R
+        if offset == 3: self.R[0] = (r0 + 1) & 0xff     # R3 access post-increments R0
+        if op[0] == 'w': self.regs[r1, r0] = op[2]
+        else: return int(self.regs[r1, r0])
+
+class emu_i2c(i2c):
+    """
+    Emulated I2C link to one chip. Every transaction holds the lock of its emulated bus for
+    latency + msg_latency per message (seconds). With probability error_rate a transaction executes
+    only a random part of its messages and raises IOError, like a NACK on the real bus.
+    """
+
+    def __init__(self, addr, bus, chip, bus_lock, latency=0., msg_latency=0., error_rate=0., seed=None):
+        super(emu_i2c, self).__init__(addr, bus)
+        self.chip = chip
+        self._lock = bus_lock
+        self.latency = latency
+        self.msg_latency = msg_latency
+        self.error_rate = error_rate
+        self._rng = random.Random(None if seed is None else hash((seed, bus, addr)))    # reproducible per chip
+        self.transactions = 0
+        self.messages = 0
+
+    def write(self, offset, byte):
+        self.transfer([('w', offset, byte)])
+        return None
+
+    def read(self, offset):
+        return self.transfer([('r', offset)])[0]
+
+    def transfer(self, ops):
+        with self._lock:
+            self.transactions += 1
+            self.messages += len(ops)
+            if self.latency or self.msg_latency: time.sleep(self.latency + self.msg_latency*len(ops))
+            nops = len(ops)
+            if self.error_rate and self._rng.random() < self.error_rate: nops = self._rng.randrange(len(ops))
+            ret = [self.chip.op(op) for op in ops[:nops]]
+            if nops < len(ops): raise IOError(121, 'Remote I/O error (emulated)')
+        return [val for val, op in zip(ret, ops) if op[0] == 'r']
+
+class emu_gpio(gpio):
+    """ Emulated reset lines of the chips of one ROC (or HexaBoard sector). """
+
+    def __init__(self, chips):
+        super(emu_gpio, self).__init__([])
+        self.chips = chips
+        self.level = 1
+
+    def write(self, val):
+        if val == 0:
+            for chip in self.chips: chip.reset()
+        self.level = val
+
+    def read(self):
+        return {'resetn': self.level}
+
+    def reset_i2c(self):
+        with self.lock.exclusive():
+            for chip in self.chips: chip.reset_i2c()
+            self.i2c_resets += 1
+
+def emu_discover(board='hd', roc_type='Si', **kwargs):
+    """ Create emulated i2c & gpio objects of a 'char', 'ld' or 'hd' board. kwargs are passed to emu_i2c. """
+
+    roc_map, rocs = emu_topologies[board]
+    defaults = RegMap(roc_type).defaults()
+    bus_locks = {bus: Lock() for _, bus in rocs}
+    i2cs, gpios = {}, {}
+    for addr, bus in rocs:
+        name = roc_map[addr]
+        chip = EmuChip(defaults)
+        i2cs[name] = emu_i2c(addr, bus, chip, bus_locks[bus], **kwargs)
+        gpios.setdefault(name[:6], emu_gpio([])).chips.append(chip)    # reset lines are shared per sector
+    print('[EMU] Emulating %s board with %d %s ROC(s)' % (board, len(rocs), roc_type))
+    return i2cs, gpios
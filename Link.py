@@ -1,16 +1,28 @@
-from smbus2 import SMBus
-import gpiod
+from smbus2 import SMBus, i2c_msg
+from threading import Condition, Lock, Thread
+from contextlib import contextmanager
+import atexit
+import yaml
+import os
+try: import gpiod
+except ImportError: gpiod = None    # only needed for xil links, e.g. not for the emulator
+
+TOPOLOGY_FILE = './topology.yaml'   # cached (bus, address) of ROCs and their GPIO lines
 
 class LinkBuilder:
     @staticmethod
-    def create(sc_type='xil'):
-        assert(sc_type in ['xil','sca'])
+    def create(sc_type='xil', topology=TOPOLOGY_FILE, **kwargs):
+        """ kwargs of sc_type 'emu' select the emulated board and its behaviour, see Emulator.emu_discover. """
+
+        assert(sc_type in ['xil','sca','emu'])
         if sc_type == 'xil': 
-            i2cs = xil_i2c_discover()
-            gpios = xil_gpio_discover()
+            i2cs, gpios = xil_discover(topology)
         elif sc_type == 'sca': 
             i2cs = []
             gpios = []
+        elif sc_type == 'emu':
+            from Emulator import emu_discover
+            i2cs, gpios = emu_discover(**kwargs)
 
 
         links = {}
@@ -25,6 +37,29 @@ class Link:
         self.i2c = i2c
         self.gpio = gpio
 
+    def close(self):
+        self.i2c.close()
+        self.gpio.close()
+
+class RetryPolicy():
+    """
+    Bounded retry of failing I2C operations: at most max_attempts attempts, waiting backoff*factor**(n-1)
+    seconds after the n-th failure. From the escalate_after-th failure on, the I2C state machine
+    of the chip is reset through its i2c_rstB GPIO line before the next attempt.
+    """
+
+    def __init__(self, max_attempts=4, backoff=0.001, factor=2, escalate_after=2):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.escalate_after = escalate_after
+
+    def delay(self, failures):
+        return self.backoff * self.factor**(failures-1)
+
+    def escalate(self, failures):
+        return self.escalate_after is not None and failures >= self.escalate_after
+
 class i2c():
     def __init__(self, addr, bus):
         self._addr = addr
@@ -36,49 +71,178 @@ class i2c():
     def read(self, *args, **kwargs):
         raise NotImplementedError
 
+    def transfer(self, ops):
+        """
+        Run a sequence of register ops [('w', offset, byte) | ('r', offset)] and return the read bytes.
+        Generic fallback: one transaction per op. Links supporting combined transfers override this.
+        """
+
+        ret = []
+        for op in ops:
+            if op[0] == 'w': self.write(op[1], op[2])
+            else: ret.append(self.read(op[1]))
+        return ret
+
+    def close(self):
+        pass
+
 class sca_i2c(i2c):
     pass
 
 def sca_i2c_discover():
     pass
 
+class SMBusPool():
+    """
+    Long-lived SMBus handles, one file descriptor per bus line.
+    All xil_i2c objects on the same bus (e.g. two ROCs per bus on HD HexaBoards) share the handle and its lock.
+    """
+
+    def __init__(self):
+        self._handles = {}
+        self._guard = Lock()
+
+    def get(self, bus_id):
+        """ Return (SMBus, Lock) for bus_id, opening the bus on first use. """
+
+        with self._guard:
+            if bus_id not in self._handles:
+                self._handles[bus_id] = (SMBus(bus_id), Lock())
+            return self._handles[bus_id]
+
+    def release(self, bus_id):
+        """ Close handle of a single bus line (e.g. after a bus error). """
+
+        with self._guard:
+            handle = self._handles.pop(bus_id, None)
+        if handle:
+            with handle[1]: handle[0].close()
+
+    def close(self):
+        """ Close all open bus handles. """
+
+        for bus_id in list(self._handles.keys()):
+            self.release(bus_id)
+
+smbus_pool = SMBusPool()
+atexit.register(smbus_pool.close)
+
 class xil_i2c(i2c):
+    MAX_MSGS = 42   # I2C_RDWR_IOCTL_MAX_MSGS: kernel limit of messages per i2c_rdwr ioctl
+
+    def __init__(self, addr, bus, pool=smbus_pool):
+        super(xil_i2c, self).__init__(addr, bus)
+        self._pool = pool
+
     def write(self, offset, byte):
-        with SMBus(self._bus) as bus:
+        bus, lock = self._pool.get(self._bus)
+        with lock:
             bus.write_byte(self._addr + offset, byte)
         return None
 
     def read(self, offset):
-        with SMBus(self._bus) as bus:
+        bus, lock = self._pool.get(self._bus)
+        with lock:
             ret = bus.read_byte(self._addr + offset)
         return ret
 
+    def transfer(self, ops):
+        """
+        Run a sequence of register ops [('w', offset, byte) | ('r', offset)] as combined i2c_rdwr transfers.
+        Each op becomes one message; a sequence is split only at the kernel's per-ioctl message limit.
+        """
+
+        msgs = []
+        for op in ops:
+            if op[0] == 'w': msgs.append(i2c_msg.write(self._addr + op[1], [op[2]]))
+            else: msgs.append(i2c_msg.read(self._addr + op[1], 1))
+
+        bus, lock = self._pool.get(self._bus)
+        with lock:
+            for idx in range(0, len(msgs), self.MAX_MSGS):
+                bus.i2c_rdwr(*msgs[idx:idx+self.MAX_MSGS])
+        return [list(msg)[0] for msg, op in zip(msgs, ops) if op[0] == 'r']
+
+    def close(self):
+        self._pool.release(self._bus)
+
 i2c_char_map = {0x28: 'roc_s0'}
 i2c_ld_map = {0x00: 'roc_s0', 0x40: 'roc_s1', 0x20: 'roc_s2'}
 i2c_hd_map = {0x18: 'roc_s0_0', 0x30: 'roc_s0_1', 0x08: 'roc_s1_0', 0x20: 'roc_s1_1', 0x10: 'roc_s2_0', 0x28: 'roc_s2_1'}
 
+def xil_discover(topology=TOPOLOGY_FILE):
+    """
+    Create i2c & gpio objects from the cached topology if all its addresses and lines still respond.
+    Otherwise (or without cache) run the full discovery and cache its result.
+    """
+
+    topo = None
+    if topology and os.path.exists(topology):
+        with open(topology) as f:
+            topo = yaml.safe_load(f)
+    if topo and xil_i2c_verify(topo['i2c']) and xil_gpio_verify(topo['gpio']):
+        print('[TOPO] Using cached topology %s' % topology)
+        return xil_i2c_create(topo['i2c']), xil_gpio_create(topo['gpio'])
+
+    if topo: print('[TOPO] Cached topology mismatch, running full discovery')
+    rocs = xil_i2c_scan()
+    i2cs = xil_i2c_create(rocs)
+    gpios = xil_gpio_discover()
+    if topology:
+        topo = {'i2c': [list(roc) for roc in rocs],
+                'gpio': {name: [[line.get_chip().name, line.offset] for line in gpio._lines] for name, gpio in gpios.items()}}
+        with open(topology, 'w') as f:
+            yaml.dump(topo, f, default_flow_style=False)
+    return i2cs, gpios
+
 def xil_i2c_discover():
     """ Discover all ROCs on i2c """
 
+    return xil_i2c_create(xil_i2c_scan())
+
+def xil_i2c_scan():
+    """ Probe all i2c bus lines in parallel and return (first addr, bus) of each ROC found. """
+
+    found = {}
+    threads = [Thread(target=xil_i2c_scan_bus, args=(bus_id, found)) for bus_id in range(8)]  # 8 i2c bus lines
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
     rocs = []
-    for bus_id in range(8):  # 8 i2c bus lines
-        try:
-            with SMBus(bus_id) as bus:
-                addrs = []
-                for addr in range(128):  # 128 addrs per bus line
-                    try:
-                        bus.read_byte(addr)
-                        addrs.append(addr)
-                    except IOError as e: 
-                        pass # skip non-existing addr
-                print('[I2C] Found %d address(es) on bus %d' % (len(addrs),bus_id))
-                if len(addrs) >= 8: 
-                    rocs.append((addrs[0], bus_id))
-                if len(addrs) == 16:
-                    rocs.append((addrs[8], bus_id))
-        except FileNotFoundError:
-            pass  # skip undefined i2c busses
-    return xil_i2c_create(rocs)
+    for bus_id, addrs in sorted(found.items()):
+        print('[I2C] Found %d address(es) on bus %d' % (len(addrs),bus_id))
+        if len(addrs) >= 8: 
+            rocs.append((addrs[0], bus_id))
+        if len(addrs) == 16:
+            rocs.append((addrs[8], bus_id))
+    return rocs
+
+def xil_i2c_scan_bus(bus_id, found):
+    """ Store responding addresses of one bus line in found[bus_id]. """
+
+    try:
+        with SMBus(bus_id) as bus:
+            addrs = []
+            for addr in range(128):  # 128 addrs per bus line
+                try:
+                    bus.read_byte(addr)
+                    addrs.append(addr)
+                except IOError as e: 
+                    pass # skip non-existing addr
+            found[bus_id] = addrs
+    except FileNotFoundError:
+        pass  # skip undefined i2c busses
+
+def xil_i2c_verify(rocs):
+    """ Check that all cached ROC addresses still respond. """
+
+    try:
+        for addr, bus_id in rocs:
+            bus, lock = smbus_pool.get(bus_id)
+            with lock: bus.read_byte(addr)
+    except (IOError, FileNotFoundError):
+        return False
+    return True
 
 def xil_i2c_create(rocs):
     """ Detect board type & create i2c objects """
@@ -95,9 +259,72 @@ def xil_i2c_create(rocs):
         roc_map = i2c_hd_map
     return {roc_map[addr]:xil_i2c(addr,bus) for (addr, bus) in rocs}
 
+def xil_gpio_create(lines):
+    """ Create gpio objects from cached {roc: [[chip name, line offset]]}. """
+
+    chips = {}
+    lines = {roc: [chips.setdefault(chip, gpiod.chip(chip)).get_line(offset) for chip, offset in offsets]
+             for roc, offsets in lines.items()}
+    return xil_gpio_share(lines)
+
+def xil_gpio_share(lines):
+    """ Create gpio objects {roc: [lines]} that share one held bank of all board lines. """
+
+    bank = xil_gpio_bank([line for roc_lines in lines.values() for line in roc_lines])
+    return {roc: xil_gpio(roc_lines, bank) for roc, roc_lines in lines.items()}
+
+def xil_gpio_verify(lines):
+    """ Check that all cached GPIO lines exist and carry one of the expected names. """
+
+    names = set(n for line_names in list(gpio_char_map.values()) + list(gpio_hexa_map.values()) for n in line_names)
+    chips = {}
+    try:
+        for offsets in lines.values():
+            for chip, offset in offsets:
+                if chips.setdefault(chip, gpiod.chip(chip)).get_line(offset).name not in names: return False
+    except (OSError, ValueError, IndexError):
+        return False
+    return True
+
+class SharedLock():
+    """ Lock held shared by any number of threads or exclusively by one. Waiting exclusive holders go first. """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try: yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if not self._shared: self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            self._cond.wait_for(lambda: not self._exclusive and not self._shared)
+            self._waiting -= 1
+            self._exclusive = True
+        try: yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
 class gpio():
+    i2c_resets = 0      # count of I2C state machine resets, lets ROCs sharing the line notice them
+
     def __init__(self, lines):
         self._lines = lines
+        self.lock = SharedLock()    # register ops of the ROCs on these lines hold it shared, reset_i2c exclusively
 
     def write(self, *args, **kwargs):
         raise NotImplementedError
@@ -105,37 +332,108 @@ class gpio():
     def read(self, *args, **kwargs):
         raise NotImplementedError
 
+    def reset_i2c(self):
+        """ Pulse only the i2c_rstB line(s), resetting the I2C state machine but keeping the register contents. """
+
+        raise NotImplementedError
+
+    @classmethod
+    def write_all(cls, gpios, val):
+        """ Drive the lines of several gpio objects to val. Generic fallback: one gpio after the other. """
+
+        for g in gpios: g.write(val)
+
+    def close(self):
+        pass
+
 class sca_gpio(gpio):
     pass
 
 def sca_gpio_discover():
     pass
 
+class xil_gpio_bank():
+    """
+    GPIO lines of a board, requested once as outputs and held until release.
+    Lines are requested together per GPIO chip, so any subset of them is set with one bulk operation per chip.
+    """
+
+    def __init__(self, lines):
+        self._bulks = {}    # chip name -> (line_bulk, [offsets], [values])
+        for line in lines:
+            bulk = self._bulks.setdefault(line.get_chip().name, (gpiod.line_bulk(), [], []))
+            bulk[0].append(line)
+            bulk[1].append(line.offset)
+        for bulk, offsets, values in self._bulks.values():
+            values.extend(self.__request(bulk, len(offsets)))
+
+    def set(self, lines, val):
+        """ Set lines to val, with one bulk write per chip; other held lines keep their value. """
+
+        for chip, (bulk, offsets, values) in self._bulks.items():
+            sel = [offsets.index(line.offset) for line in lines if line.get_chip().name == chip]
+            if not sel: continue
+            for idx in sel: values[idx] = val
+            bulk.set_values(values)
+
+    def get(self, lines):
+        return {line.name: line.get_value() for line in lines}
+
+    def release(self):
+        for bulk, _, _ in self._bulks.values():
+            bulk.release()
+        self._bulks = {}
+
+    def __request(self, bulk, nlines):
+        """
+        Request lines directly as outputs at their inactive level (1): the reset lines are active low,
+        and releasing the driver to read their level first could let them float low and reset the chips.
+        """
+
+        config = gpiod.line_request()
+        config.consumer = "xil_gpio"
+        config.request_type = gpiod.line_request.DIRECTION_OUTPUT
+        values = [1] * nlines
+        bulk.request(config, values)
+        return values
+
 class xil_gpio(gpio):
+    """ GPIO lines of one ROC (or HexaBoard sector), as a view on a held xil_gpio_bank. """
+
+    def __init__(self, lines, bank=None):
+        super(xil_gpio, self).__init__(lines)
+        self._bank = bank or xil_gpio_bank(lines)
 
     def write(self, val):
-        for line in self._lines:
-            config = gpiod.line_request()
-            config.consumer = "xil_gpio_write"
-            config.request_type = gpiod.line_request.DIRECTION_OUTPUT
-            line.request(config)
-            line.set_value(val)
-            line.release()
+        self._bank.set(self._lines, val)
 
     def read(self):
-        ans = {}
-        for line in self._lines:
-            config = gpiod.line_request()
-            config.consumer = "xil_gpio_read"
-            config.request_type = gpiod.line_request.DIRECTION_INPUT
-            line.request(config)
-            ans[line.name] = line.get_value()
-        return ans
+        return self._bank.get(self._lines)
+
+    def reset_i2c(self):
+        lines = [line for line in self._lines if line.name in gpio_i2c_rstB]
+        with self.lock.exclusive():     # not in the middle of a sibling's register op
+            self._bank.set(lines, 0)
+            self._bank.set(lines, 1)
+            self.i2c_resets += 1
+
+    @classmethod
+    def write_all(cls, gpios, val):
+        """ Drive the lines of several gpio objects to val with one bulk operation per bank and chip. """
+
+        banks = {}
+        for g in gpios: banks.setdefault(id(g._bank), (g._bank, []))[1].extend(g._lines)
+        for bank, lines in banks.values():
+            bank.set(lines, val)
+
+    def close(self):
+        self._bank.release()
 
 gpio_char_map = {'roc_s0': ['hgcroc_rstB', 'resyncload', 'hgcroc_i2c_rstB']}
 gpio_hexa_map = {'roc_s0': ['s0_resetn', 's0_resyncload', 's0_i2c_rstn'], 
                  'roc_s1': ['s1_resetn', 's1_resyncload', 's1_i2c_rstn'], 
                  'roc_s2': ['s2_resetn', 's2_resyncload', 's2_i2c_rstn']}
+gpio_i2c_rstB = set(names[2] for names in list(gpio_char_map.values()) + list(gpio_hexa_map.values()))
 
 def xil_gpio_discover():
     # get all lines on all connected gpio chips
@@ -147,13 +445,13 @@ def xil_gpio_discover():
     # check if line names are in char map
     sel_names = set(gpio_char_map['roc_s0']).intersection([l.name for l in lines])
     if sel_names:
-        return {'roc_s0': xil_gpio([l for l in lines if l.name in sel_names])}
+        return xil_gpio_share({'roc_s0': [l for l in lines if l.name in sel_names]})
     else:
         ret = {}
         # check if line names in hexa map
         for roc, line_names in gpio_hexa_map.items():
             sel_names = set(line_names).intersection([l.name for l in lines])
             if sel_names:
-                ret[roc] = xil_gpio([l for l in lines if l.name in sel_names])
-        if ret: return ret
-        else: raise('Missing HexaBoard GPIO lines.')
+                ret[roc] = [l for l in lines if l.name in sel_names]
+        if ret: return xil_gpio_share(ret)
+        else: raise Exception('Missing HexaBoard GPIO lines.')
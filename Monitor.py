@@ -0,0 +1,107 @@
+from threading import Thread, Event, Lock
+from Adc import AdcChannel
+from Protocol import Codec
+import numpy as np
+import time
+import zmq
+
+"""
+Background monitoring of the Trophy ADCs: samples are taken in a thread at a fixed rate,
+kept in a ring buffer for windowed queries and published on a ZMQ PUB socket as [b'monitor', sample].
+"""
+
+class Ring():
+    """ Fixed-size ring buffer of timestamped samples of nchan channels. """
+
+    def __init__(self, size, nchan):
+        self.times = np.zeros(size)
+        self.values = np.zeros((size, nchan))
+        self.head = 0       # next slot to write
+        self.count = 0
+        self.lock = Lock()
+
+    def append(self, t, vals):
+        with self.lock:
+            self.times[self.head] = t
+            self.values[self.head] = vals
+            self.head = (self.head + 1) % len(self.times)
+            self.count = min(self.count + 1, len(self.times))
+
+    def window(self, seconds=None):
+        """ (times, values) of the samples of the last seconds (default: all), oldest first. """
+
+        with self.lock:
+            idx = (self.head - self.count + np.arange(self.count)) % len(self.times)
+            times, values = self.times[idx], self.values[idx]
+        if seconds is not None:
+            sel = times >= time.time() - seconds
+            times, values = times[sel], values[sel]
+        return times, values
+
+class Monitor():
+    """ Sample ADC channels {name: sysfs file} at rate (Hz) into a ring of size samples, optionally publishing on port. """
+
+    def __init__(self, adcs, rate=1., size=3600, port=None, codec='yaml'):
+        self.channels = {name: AdcChannel(fname) for name, fname in adcs.items()}   # own fds, independent of requests
+        self.names = list(self.channels.keys())
+        self.period = 1. / rate
+        self.ring = Ring(size, len(self.names))
+        self.port = port
+        self.codec = Codec(codec)
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self.__run, name='monitor', daemon=True)
+        self.thread.start()
+        print('[MON] Sampling %d ADC channels at %g Hz%s' % (len(self.names), 1. / self.period,
+              ', publishing on port %d' % self.port if self.port else ''))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread: self.thread.join()
+        for channel in self.channels.values(): channel.close()
+
+    def latest(self, names=None):
+        """ Last sample {'time': t, name: value} of names (default: all channels). """
+
+        times, values = self.ring.window()
+        if not len(times): return {}
+        sample = dict(zip(self.names, values[-1].tolist()))
+        return dict({'time': float(times[-1])}, **{name: sample[name] for name in names or self.names})
+
+    def query(self, cfg=None):
+        """
+        Aggregates of the samples of the last cfg['window'] seconds (default: whole buffer),
+        per channel of cfg['channels'] (default: all): {'n', 't0', 't1', name: {mean, min, max, std, last}}.
+        """
+
+        cfg = cfg or {}
+        times, values = self.ring.window(cfg.get('window'))
+        res = {'n': len(times), 't0': float(times[0]) if len(times) else None, 't1': float(times[-1]) if len(times) else None}
+        if not len(times): return res
+        for name in cfg.get('channels') or self.names:
+            vals = values[:, self.names.index(name)]
+            res[name] = {'mean': float(vals.mean()), 'min': float(vals.min()), 'max': float(vals.max()),
+                         'std': float(vals.std()), 'last': float(vals[-1])}
+        return res
+
+    def __run(self):
+        """ Sampling loop on a fixed schedule; the PUB socket is owned by this thread. """
+
+        socket = None
+        if self.port:
+            socket = zmq.Context.instance().socket(zmq.PUB)
+            socket.bind("tcp://*:%d" % self.port)
+        try:
+            deadline = time.time()
+            while not self.stopped.is_set():
+                t = time.time()
+                vals = [self.channels[name].sample() for name in self.names]
+                self.ring.append(t, vals)
+                if socket: socket.send_multipart([b'monitor', self.codec.dumps(dict(zip(self.names, vals), time=t))])
+                deadline = max(deadline + self.period, time.time())     # skip missed slots instead of bursting
+                self.stopped.wait(deadline - time.time())
+        finally:
+            if socket: socket.close(linger=0)
@@ -0,0 +1,87 @@
+from itertools import groupby
+
+class Plan():
+    """ Ordered write/read groups (2d sortedPairs list) with estimated I2C cost. """
+
+    def __init__(self, groups, transactions, messages, fills=()):
+        self.groups = groups
+        self.transactions = transactions    # I2C transactions (ioctls) to execute the plan
+        self.messages = messages            # single-byte I2C messages on the bus
+        self.fills = fills                  # (addr, val) gap registers rewritten with their known value
+
+    def fits(self, roc):
+        """ True if the plan's gap fills match the known registers of roc, so it can be reused for that ROC. """
+
+        return all(roc.known[addr[1], addr[0]] and roc.shadow[addr[1], addr[0]] == val for addr, val in self.fills)
+
+    def __repr__(self):
+        return 'Plan(%d groups, %d transactions, %d messages)' % (len(self.groups), self.transactions, self.messages)
+
+class BurstPlanner():
+    """
+    Plan the cheapest transaction schedule for a set of registers.
+    Cost model: with combined transfers (ROC.combined) every group is one transaction of
+    R0/R1 setup + data messages; otherwise every message is its own transaction.
+    One transaction is weighted as xfer_cost messages when deciding whether to bridge a gap.
+    """
+
+    def __init__(self, burst_limit=20, xfer_cost=4):
+        self.burst_limit = burst_limit
+        self.xfer_cost = xfer_cost
+
+    def plan(self, pairs, roc=None):
+        """
+        Plan addr:val pairs for roc. Gaps between runs on the same R1 page are bridged by
+        re-writing the known (shadow) values of the gap registers when cheaper than a new group.
+        Without roc (e.g. for reads), runs are only merged when strictly consecutive.
+        """
+
+        prev_addr = roc.prev_addr if roc else (None, None)
+        combined = roc.combined if roc else True
+        addrs = sorted(pairs.keys(), key=lambda addr: (addr[1] != prev_addr[1], addr[1], addr[0]))
+
+        groups, fills = [], []
+        for page, page_addrs in groupby(addrs, key=lambda addr: addr[1]):
+            group = []
+            for addr in page_addrs:
+                fill = self.__fill(group, addr, roc, combined) if group else None
+                if fill is None:                        # start a new group
+                    if group: groups.append(group)
+                    group = []
+                else:
+                    group.extend(fill)
+                    fills.extend(fill)
+                group.append((addr, pairs[addr]))
+            groups.append(group)
+
+        sortedPairs = [[{addr: val} for addr, val in group] for group in groups]
+        return Plan(sortedPairs, *self.estimate(sortedPairs, prev_addr, combined), fills=fills)
+
+    def estimate(self, sortedPairs, prev_addr=(None, None), combined=True):
+        """
+        Estimate (transactions, messages) to execute sortedPairs, e.g. to compare planning strategies.
+        Follows ROC.write: combined, every group (single register or burst) is one transfer; otherwise every
+        R0/R1/R2/R3 access is a transaction of its own.
+        """
+
+        transactions, messages = 0, 0
+        for subList in sortedPairs:
+            addr = list(subList[0].keys())[0]
+            nmsgs = (addr[0] != prev_addr[0]) + (addr[1] != prev_addr[1]) + len(subList)
+            messages += nmsgs
+            transactions += 1 if combined else nmsgs
+            prev_addr = (addr[0] + len(subList), addr[1]) if len(subList) > 1 else addr
+        return transactions, messages
+
+    def __fill(self, group, addr, roc, combined):
+        """ Return gap-filling (addr, known value) pairs to append addr to group, or None to start a new group. """
+
+        page = addr[1]
+        gap = range(group[-1][0][0]+1, addr[0])
+        if len(group) + len(gap) + 1 > self.burst_limit: return None
+        if not gap: return []
+        if roc is None: return None
+        # Bridging costs one message per gap register; a new group costs an R0 message (+ a transfer if combined).
+        if len(gap) > 1 + (self.xfer_cost if combined else 0): return None
+        if not all(roc.known[page, r0] for r0 in gap): return None
+        return [((r0, page), int(roc.shadow[page, r0])) for r0 in gap]
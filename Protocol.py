@@ -0,0 +1,42 @@
+import yaml
+import zlib
+import numpy as np
+try: import msgpack
+except ImportError: msgpack = None   # binary protocol unavailable, YAML only
+
+""" Wire encodings for ZMQ payloads: YAML (default, human-readable) or msgpack, optionally zlib-compressed. """
+
+class Codec():
+    """ Encode/decode payloads. Negotiated per connection by name, e.g. 'yaml', 'msgpack' or 'msgpack+zlib'. """
+
+    def __init__(self, name='yaml'):
+        fmt, _, comp = name.lower().partition('+')
+        if fmt not in ('yaml', 'msgpack'): raise ValueError('Unknown protocol %s.' % name)
+        if fmt == 'msgpack' and msgpack is None: raise ValueError('msgpack not installed on server.')
+        if comp not in ('', 'zlib'): raise ValueError('Unknown compression %s.' % comp)
+        self.name = name.lower()
+        self.fmt = fmt
+        self.compress = comp == 'zlib'
+
+    def dumps(self, obj):
+        if self.fmt == 'yaml': data = (obj if isinstance(obj, str) else yaml.dump(obj, default_flow_style=False)).encode()
+        else: data = msgpack.packb(obj, use_bin_type=True)
+        return zlib.compress(data, 1) if self.compress else data
+
+    def loads(self, data):
+        if not data: return None
+        if self.compress: data = zlib.decompress(data)
+        if self.fmt == 'yaml': return yaml.safe_load(data.decode())
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+def pack_regs(pairs):
+    """ {(R0,R1): val} -> bytes of packed (R0, R1, val) uint8 triples. Values of None are packed as 0. """
+
+    regs = np.array([(addr[0], addr[1], val or 0) for addr, val in pairs.items()], dtype=np.uint8).reshape(-1, 3)
+    return regs.tobytes()
+
+def unpack_regs(data):
+    """ bytes of packed (R0, R1, val) uint8 triples -> {(R0,R1): val} """
+
+    regs = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).tolist()
+    return {(r0, r1): val for r0, r1, val in regs}
@@ -1,9 +1,68 @@
+from Planner import BurstPlanner
+from Link import RetryPolicy
+from Stats import stats
+from collections import Counter
+from threading import Lock
+import numpy as np
+import time
+
 class ROC(object):
     """ Interface to ROC on register-level. """
 
-    def __init__(self, link):
+    BURST_LIMIT = 20    # max. consecutive registers per burst (no wrapping between R0 and R1)
+
+    def __init__(self, link, combined=True, retry=None, name='roc'):
         self.prev_addr = (None, None)
         self.link = link
+        self.name = name            # label in stats and messages
+        self.combined = combined    # burst via one combined I2C transfer, else byte-per-transaction
+        self.retry = retry or RetryPolicy()
+        self.retries = Counter()    # (R0,R1) of group start -> failed attempts, to spot marginal chips
+        self.__retries_lock = Lock()    # retries are counted on bus workers and read by status requests
+        self.escalations = 0        # I2C state machine resets triggered by this ROC
+        self.__i2c_resets = link.gpio.i2c_resets
+        self.shadow = np.zeros((256, 256), dtype=np.uint8)  # register image indexed by (R1, R0)
+        self.known = np.zeros((256, 256), dtype=bool)       # shadow entries that reflect the chip
+        self.layout = {}                                    # R1 page -> mapped R0 addresses, see set_layout
+
+    def set_layout(self, keys):
+        """ Register the mapped addresses (keys R1<<8 | R0), so that shadow pages are read as a whole. """
+
+        keys = np.unique(keys)
+        self.layout = {int(page): keys[keys >> 8 == page] for page in np.unique(keys >> 8)}
+
+    def shadow_values(self, keys):
+        """ Return shadow register values for address keys (R1<<8 | R0), reading unknown pages from the chip. """
+
+        r1, r0 = keys >> 8, keys & 0xff
+        missing = ~self.known[r1, r0]
+        if missing.any():
+            for page in np.unique(r1[missing]).tolist():
+                page_keys = np.union1d(self.layout.get(page, []), keys[missing][r1[missing] == page]).astype(np.int64)
+                self.read(self.group_keys(page_keys[~self.known[page, page_keys & 0xff]]))
+        return self.shadow[r1, r0]
+
+    def assume(self, pairs):
+        """ Take addr:val pairs as known register state without I/O (e.g. restored from a snapshot). """
+
+        self.__update_shadow(pairs)
+
+    def changed(self, pairs):
+        """ Return the addr:val pairs whose value differs from the known register state. """
+
+        return {addr: val for addr, val in pairs.items()
+                if not self.known[addr[1], addr[0]] or self.shadow[addr[1], addr[0]] != val}
+
+    def changed_mask(self, keys, vals):
+        """ Vectorized changed: mask of address keys (R1<<8 | R0) whose value differs from the known register state. """
+
+        r1, r0 = keys >> 8, keys & 0xff
+        return ~self.known[r1, r0] | (self.shadow[r1, r0] != vals)
+
+    def group_keys(self, keys):
+        """ Group address keys into bursts of consecutive R0 on the same R1, at most BURST_LIMIT long. """
+
+        return BurstPlanner(self.BURST_LIMIT).plan({(key & 0xff, key >> 8): None for key in keys.tolist()}).groups
 
     def read(self, sortedPairs):
         """ Read/Burst-Read addresses in addr:val pairs in 2d sortedPairs list. """
@@ -11,13 +70,15 @@ class ROC(object):
         pairs = {}
         for subList in sortedPairs:
             addr = list(subList[0].keys())[0]
+            self.__count_group(len(subList))
             if len(subList) > 1:
-                vals = self.__burst_read_param(addr, len(subList))
+                vals = self.__attempt(self.__burst_read, addr, len(subList))
                 for pair, val in zip(subList, vals):
                     addr = list(pair.keys())[0]
                     pairs[addr] = val
             else:
-                pairs[addr] = self.__read_param(addr)
+                pairs[addr] = self.__attempt(self.__single_read, addr)
+        self.__update_shadow(pairs)
         return pairs
 
     def write(self, sortedPairs):
@@ -25,15 +86,78 @@ class ROC(object):
 
         for subList in sortedPairs:
             addr = list(subList[0].keys())[0]
+            self.__count_group(len(subList))
             if len(subList) > 1:        # burst-write for grouped pairs
                 vals = [v for pair in subList for k, v in pair.items()]
-                self.__burst_write_param(addr, vals)
+                self.__attempt(self.__burst_write, addr, vals)
             else:
-                self.__write_param(addr, subList[0][addr])
+                self.__attempt(self.__single_write, addr, subList[0][addr])
+            self.__update_shadow({k: v for pair in subList for k, v in pair.items()})
 
     def reset(self):
         self.link.gpio.write(0)
         self.link.gpio.write(1)
+        self.invalidate()
+
+    def invalidate(self):
+        """ Forget chip state after a reset (also when pulsed for several ROCs at once, see CharBoard.reset). """
+
+        self.prev_addr = (None, None)   # R0/R1 are reset with the chip
+        self.known[:] = False
+
+    def __attempt(self, op, addr, *args):
+        """
+        Run a register op (address setup + data) under the retry policy. A failed op is repeated as a whole
+        from a fresh R0/R1 setup, since a partial transfer leaves R0 at an unknown position.
+        """
+
+        failures = 0
+        gpio = self.link.gpio
+        while True:
+            try:
+                with gpio.lock.shared():    # no I2C state machine reset of the sector during the op
+                    if gpio.i2c_resets != self.__i2c_resets:     # reset since the last op, e.g. by a sector sibling
+                        self.__i2c_resets = gpio.i2c_resets
+                        self.prev_addr = (None, None)
+                    with stats.span('i2c.group_us'): return op(addr, *args)
+            except IOError as e:
+                failures += 1
+                self.__count_retry(addr)
+                self.prev_addr = (None, None)
+                if failures >= self.retry.max_attempts: raise
+                print('[%s] IOError at %s (attempt %d/%d): %s' % (self.name, addr, failures, self.retry.max_attempts, e))
+                if self.retry.escalate(failures): self.__reset_i2c()
+                time.sleep(self.retry.delay(failures))
+
+    def __reset_i2c(self):
+        """ Escalation: reset the I2C state machine via the i2c_rstB line, if the link supports it. """
+
+        try: self.link.gpio.reset_i2c()
+        except NotImplementedError: return
+        self.escalations += 1
+        stats.count('i2c.escalations.' + self.name)
+        print('[%s] I2C state machine reset.' % self.name)
+
+    def retry_counts(self):
+        """ Copy of the failed attempts per group start address, safe to iterate while the bus is in use. """
+
+        with self.__retries_lock: return Counter(self.retries)
+
+    def __count_retry(self, addr):
+        with self.__retries_lock: self.retries[addr] += 1
+        stats.count('i2c.retries.' + self.name)
+
+    def __count_group(self, nregs):
+        stats.count('i2c.bytes.' + self.name, nregs)
+        stats.observe('i2c.burst_size', nregs)
+
+    def __update_shadow(self, pairs):
+        """ Record written/read addr:val pairs in the shadow register file. """
+
+        for (r0, r1), val in pairs.items():
+            if val is None: continue
+            self.shadow[r1, r0] = val
+            self.known[r1, r0] = True
 
     def __write_param(self, addr, val):
         """ Write parameter value (to R2). """
@@ -44,6 +168,93 @@ class ROC(object):
         self.prev_addr = addr
         return val
 
+    def __single_write(self, addr, val):
+        """ Write one register via combined transfer, fall back to per-byte writes if disabled or on bus error. """
+
+        if self.combined:
+            try: return self.__transfer_write_single(addr, val)
+            except IOError as e:
+                print('[%s] IOError in combined write. Falling back to per-byte write.' % self.name)
+                self.__count_retry(addr)
+                self.prev_addr = (None, None)
+        return self.__write_param(addr, val)
+
+    def __single_read(self, addr):
+        """ Read one register via combined transfer, fall back to per-byte reads if disabled or on bus error. """
+
+        if self.combined:
+            try: return self.__transfer_read_single(addr)
+            except IOError as e:
+                print('[%s] IOError in combined read. Falling back to per-byte read.' % self.name)
+                self.__count_retry(addr)
+                self.prev_addr = (None, None)
+        return self.__read_param(addr)
+
+    def __burst_write(self, addr, vals):
+        """ Burst-write via combined transfer, fall back to per-byte burst if disabled or on bus error. """
+
+        if self.combined:
+            try: return self.__transfer_write_param(addr, vals)
+            except IOError as e:
+                print('[%s] IOError in combined burst-write. Falling back to per-byte burst.' % self.name)
+                self.__count_retry(addr)
+                self.prev_addr = (None, None)   # R0/R1 state unknown after partial transfer
+        self.__burst_write_param(addr, vals)
+
+    def __burst_read(self, addr, nregs):
+        """ Burst-read via combined transfer, fall back to per-byte burst if disabled or on bus error. """
+
+        if self.combined:
+            try: return self.__transfer_read_param(addr, nregs)
+            except IOError as e:
+                print('[%s] IOError in combined burst-read. Falling back to per-byte burst.' % self.name)
+                self.__count_retry(addr)
+                self.prev_addr = (None, None)
+        return self.__burst_read_param(addr, nregs)
+
+    def __transfer_write_param(self, addr, vals):
+        """ Set Start Address (R0,R1) and write all values to R3 in one combined I2C transfer. """
+
+        ops = self.__addr_ops(addr) + [('w', 0x03, val) for val in vals]
+        stats.count('i2c.transactions')
+        self.link.i2c.transfer(ops)
+        self.prev_addr = (addr[0] + len(vals), addr[1])     # R0 post-incremented after each R3 op.
+
+    def __transfer_read_param(self, addr, nregs):
+        """ Set Start Address (R0,R1) and read nregs values from R3 in one combined I2C transfer. """
+
+        ops = self.__addr_ops(addr) + [('r', 0x03)] * nregs
+        stats.count('i2c.transactions')
+        vals = self.link.i2c.transfer(ops)
+        self.prev_addr = (addr[0] + nregs, addr[1])
+        return vals
+
+    def __transfer_write_single(self, addr, val):
+        """ Set address (R0,R1) and write val to R2 in one combined I2C transfer. """
+
+        ops = self.__addr_ops(addr) + [('w', 0x02, val)]
+        stats.count('i2c.transactions')
+        self.link.i2c.transfer(ops)
+        self.prev_addr = addr       # R2 access does not increment R0
+        return val
+
+    def __transfer_read_single(self, addr):
+        """ Set address (R0,R1) and read R2 in one combined I2C transfer. """
+
+        ops = self.__addr_ops(addr) + [('r', 0x02)]
+        stats.count('i2c.transactions')
+        val = self.link.i2c.transfer(ops)[0]
+        self.prev_addr = addr
+        return val
+
+    def __addr_ops(self, addr):
+        """ Transfer ops to set (R0,R1), skipping registers that already hold the address. """
+
+        ops = []
+        if addr[0] != self.prev_addr[0]: ops.append(('w', 0x00, addr[0]))
+        if addr[1] != self.prev_addr[1]: ops.append(('w', 0x01, addr[1]))
+        return ops
+
     def __burst_write_param(self, addr, vals):
         """
         Set Start Address (R0,R1) and consecutively write to R3, while updating write cache.
@@ -76,29 +287,22 @@ class ROC(object):
             naddr = (addr[0] + idx, addr[1])
             val = self.__read_I2C_reg(0x03)
             vals.append(val)
-        self.prev_addr = naddr
+        self.prev_addr = (naddr[0]+1, naddr[1]) # R3 read is one R0 step ahead.
         return vals
 
     def __read_I2C_reg(self, reg_id):
-        """ Read byte from register. """
+        """ Read byte from register. IOErrors are retried per register op, see __attempt. """
 
-        try: 
-            return self.link.i2c.read(reg_id)
-        except IOError as e:
-            print('IOError in read. Attempting re-read.')
-            self.__read_I2C_reg(reg_id)
-        except Exception: raise     # For all other errors reset the I2C state machine and the chip.
+        stats.count('i2c.transactions')
+        return self.link.i2c.read(reg_id)
 
     def __set_I2C_reg(self, reg_id, val):
         """
         Write byte to register.
         Registers are treated as offset (reg_id) from ROC's first address on bus (self.link.i2c._addr).
         Ex. first address 0x20, reg_id=2 -> write val to 0x22.
+        IOErrors are retried per register op, see __attempt.
         """
 
-        try: 
-            return self.link.i2c.write(reg_id, val)
-        except IOError as e:
-            print('IOError in write. Attempting re-write.')
-            self.__set_I2C_reg(reg_id, val)
-        except Exception: raise  # For all other errors reset the I2C state machine and the chip.
+        stats.count('i2c.transactions')
+        return self.link.i2c.write(reg_id, val)
@@ -0,0 +1,127 @@
+import numpy as np
+import csv
+import os
+
+""" Compiled register map: flat structured array of register entries, built from reg_maps/*.csv. """
+
+regmap_dtype = np.dtype([('block', 'S16'), ('blockId', 'u1'), ('param', 'S32'), ('reg_id', 'u1'),
+                         ('R0', 'u1'), ('R1', 'u1'), ('defval_mask', 'u1'),
+                         ('param_mask', 'u4'), ('param_minbit', 'u1'), ('reg_mask', 'u1'),
+                         ('param_shift', 'u1'), ('reg_shift', 'u1')])
+
+regmap_files = {'Si':   './reg_maps/HGCROCv2_I2C_params_regmap',
+                'SiPM': './reg_maps/HGCROCv2_sipm_I2C_params_regmap'}
+
+def lsb_id(mask):
+    """ Return position of least significant bit of each mask value. """
+
+    mask = np.asarray(mask, dtype=np.int64)
+    return (np.log2(mask & -mask)).astype(np.uint8)
+
+def compile_regmap(csv_fname, npy_fname=None):
+    """ Build the structured register table from a register map CSV, sorted by (block, blockId, param, reg_id). """
+
+    with open(csv_fname) as f:
+        rows = list(csv.DictReader(f))
+
+    table = np.zeros(len(rows), dtype=regmap_dtype)
+    table['block'] = [r['SubBlock'] for r in rows]
+    table['param'] = [r['parameter'] for r in rows]
+    for field, col in [('blockId', 'BlockID'), ('reg_id', 'reg_id'), ('R0', 'R0'), ('R1', 'R1'),
+                       ('defval_mask', 'defval_mask'), ('param_mask', 'param_mask'),
+                       ('param_minbit', 'param_minbit'), ('reg_mask', 'reg_mask')]:
+        table[field] = [int(r[col]) for r in rows]
+    table['param_shift'] = lsb_id(table['param_mask'])
+    table['reg_shift'] = lsb_id(table['reg_mask'])
+    table = table[np.lexsort((table['reg_id'], table['param'], table['blockId'], table['block']))]
+
+    if npy_fname: np.save(npy_fname, table)
+    return table
+
+class RegMap():
+    """
+    Memory-mapped register table with an integer index (block, blockId, param) -> rows.
+    Each instance owns its own table and index, so Si and SiPM maps never share state.
+    """
+
+    def __init__(self, roc_type):
+        if roc_type not in regmap_files: raise Exception("Specified ROC type unknown.")
+        self.roc_type = roc_type
+        self.table = self.__load(regmap_files[roc_type])
+        self.index = self.__build_index(self.table)
+        self.param_keys = list(self.index.keys())                       # param id -> (block, blockId, param)
+        self.param_ids = np.repeat(np.arange(len(self.param_keys)), [e - s for s, e in self.index.values()])
+        self.param_nrows = np.bincount(self.param_ids)                  # param id -> number of register entries
+        self.__build_addr_index(self.table)
+        self.blocks = {}
+        for (block, blockId, param) in self.index.keys():
+            blockIds = self.blocks.setdefault(block, [])
+            if blockId not in blockIds: blockIds.append(blockId)
+
+    def regs(self, block, blockId, param):
+        """ (block, blockId, param) -> structured rows (R0, R1, masks, shifts, ...) of that parameter. """
+
+        start, stop = self.index[(block, blockId, param)]
+        return self.table[start:stop]
+
+    def rows_at(self, keys):
+        """
+        Reverse lookup: address keys (R1<<8 | R0) -> (row indices of all entries in these registers,
+        position in keys of each row). Unmapped addresses have no rows.
+        """
+
+        keys = np.asarray(keys, dtype=np.int64)
+        pos = np.searchsorted(self.addr_uniq, keys).clip(0, len(self.addr_uniq) - 1)
+        hit = np.flatnonzero(self.addr_uniq[pos] == keys)
+        counts = self.addr_counts[pos[hit]]
+        owner = np.repeat(hit, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.addr_order[np.repeat(self.addr_starts[pos[hit]], counts) + offsets], owner
+
+    def defaults(self):
+        """ Register image after reset, indexed by (R1, R0), from the defval_mask of all entries. """
+
+        regs = np.zeros((256, 256), dtype=np.uint8)
+        np.bitwise_or.at(regs, (self.table['R1'], self.table['R0']), self.table['defval_mask'])
+        return regs
+
+    def addr_keys(self):
+        """ All mapped register addresses as sorted keys R1<<8 | R0. """
+
+        return np.unique((self.table['R1'].astype(np.int64) << 8) | self.table['R0'])
+
+    def block_ids(self, block):
+        """ All block IDs of a block (e.g. 72 for 'ch'). """
+
+        return self.blocks[block]
+
+    def __load(self, fname):
+        """ Memory-map the compiled table, (re)compiling it if missing or older than the CSV. """
+
+        csv_fname, npy_fname = fname + '.csv', fname + '.npy'
+        if not os.path.exists(npy_fname) or os.path.getmtime(npy_fname) < os.path.getmtime(csv_fname):
+            try: compile_regmap(csv_fname, npy_fname)
+            except OSError: return compile_regmap(csv_fname)    # read-only install: keep in memory
+        return np.load(npy_fname, mmap_mode='r')
+
+    def __build_addr_index(self, table):
+        """ Rows sorted by address key, with the [start, start+count) range of each mapped address. """
+
+        keys = (table['R1'].astype(np.int64) << 8) | table['R0']
+        self.addr_order = np.argsort(keys, kind='stable')
+        self.addr_uniq, self.addr_starts, self.addr_counts = np.unique(keys[self.addr_order], return_index=True, return_counts=True)
+
+    def __build_index(self, table):
+        """ Map each (block, blockId, param) to its [start, stop) row range in the sorted table. """
+
+        keys = table[['block', 'blockId', 'param']]
+        bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts = np.concatenate(([0], bounds))
+        stops = np.concatenate((bounds, [len(table)]))
+        return {(table['block'][s].decode(), int(table['blockId'][s]), table['param'][s].decode()): (int(s), int(e))
+                for s, e in zip(starts, stops)}
+
+if __name__ == "__main__":
+    for roc_type, fname in regmap_files.items():
+        table = compile_regmap(fname + '.csv', fname + '.npy')
+        print('[RegMap] Compiled %s map: %d register entries -> %s.npy' % (roc_type, len(table), fname))
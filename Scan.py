@@ -0,0 +1,98 @@
+from itertools import product
+from copy import deepcopy
+import time
+
+class Scan():
+    """
+    Parameter sweep executed on the board in one request.
+
+    spec = {'base':    {roc_label: cfg},                  # configured once before the sweep (optional)
+            'params':  [{'path': [roc_label, block, blockId, param], 'values': [...]},
+                        {'key': param, 'range': [start, stop, step]}, ...],  # 'key': every occurrence in base
+            'product': True,                              # cartesian product of params, else zipped
+            'dwell':   0.0,                               # seconds to wait after each step
+            'read_adc': False,                            # HexaBoard.read_adc of base with step values
+            'read':    {roc_label: cfg}}                  # read back after each step (optional)
+
+    The register rows of every scanned parameter are selected once, so a step only recomputes
+    the scanned register values and writes the registers that changed.
+    """
+
+    def __init__(self, board, spec):
+        self.board = board
+        self.base = spec.get('base') or {}
+        self.product = spec.get('product', True)
+        self.dwell = spec.get('dwell', 0)
+        self.read_adc = spec.get('read_adc', False)
+        self.read = spec.get('read')
+        self.params = [(self.__paths(p), self.__values(p)) for p in spec['params']]
+        self.rows = self.__compile()
+
+    def steps(self):
+        """ Tuples of one value per scanned parameter. """
+
+        values = [vals for _, vals in self.params]
+        return product(*values) if self.product else zip(*values)
+
+    def run(self, progress=None):
+        """ Run the sweep; progress(step result) is called after every step. Return all step results. """
+
+        if self.base and not self.read_adc: self.board.configure(self.base)
+        results = []
+        for idx, values in enumerate(self.steps()):
+            res = {'step': idx, 'values': list(values)}
+            if self.read_adc:
+                res['adc'] = self.board.read_adc(self.__substitute(values))
+            else:
+                self.board.apply(self.__deltas(values))
+            if self.dwell: time.sleep(self.dwell)
+            if self.read: res['read'] = self.board.read(self.read)
+            if progress: progress(res)
+            results.append(res)
+        return results
+
+    def __compile(self):
+        """ Select register rows per ROC label once: label -> [(rows, param index)]. """
+
+        rows = {}
+        for pidx, (paths, _) in enumerate(self.params):
+            for lbl, block, blockId, param in paths:
+                rows.setdefault(lbl, []).append((self.board.translator.select(block, blockId, param), pidx))
+        return rows
+
+    def __deltas(self, values):
+        """ Register deltas {roc_name: [delta]} of one step. """
+
+        deltas = {}
+        for lbl, sels in self.rows.items():
+            delta = self.board.translator.compile_rows([sel for sel, _ in sels], [values[pidx] for _, pidx in sels])
+            for rname in [name for name in self.board.rocs.keys() if lbl in name]:
+                deltas.setdefault(rname, []).append(delta)
+        return deltas
+
+    def __substitute(self, values):
+        """ Base config with the step values filled in (for commands that take a full config). """
+
+        cfg = deepcopy(self.base)
+        for (paths, _), val in zip(self.params, values):
+            for lbl, block, blockId, param in paths:
+                blk_cfg = cfg.setdefault(lbl, {})
+                blk_cfg = blk_cfg['sc'] if 'sc' in blk_cfg else blk_cfg
+                blk_cfg.setdefault(block, {}).setdefault(blockId, {})[param] = val
+        return cfg
+
+    def __paths(self, p):
+        """ Explicit [roc_label, block, blockId, param] path, or all paths of key 'key' in base. """
+
+        if 'path' in p: return [tuple(k for k in p['path'] if k != 'sc')]
+        paths = []
+        for lbl, cfg in self.base.items():
+            cfg = cfg['sc'] if 'sc' in cfg else cfg
+            for block, blk_cfg in cfg.items():
+                for blockId, params in blk_cfg.items():
+                    if p['key'] in params: paths.append((lbl, block, blockId, p['key']))
+        if not paths: raise KeyError('Scan key %s not found in base config.' % p['key'])
+        return paths
+
+    def __values(self, p):
+        return list(p['values']) if 'values' in p else list(range(*p['range']))
@@ -0,0 +1,61 @@
+from itertools import groupby
+from collections import deque
+from threading import Thread
+
+class PropagatingThread(Thread):
+    """ Thread class to propagate occuring Exceptions to the calling thread. """
+
+    def run(self):
+        self.exc = None
+        try: self.ret = self._target(*self._args, **self._kwargs)
+        except BaseException as e: self.exc = e     # store exception
+
+    def join(self):
+        super(PropagatingThread, self).join()
+        if self.exc: raise self.exc
+        return self.ret
+
+class BusScheduler():
+    """
+    Run per-ROC register groups with one worker thread per physical I2C bus.
+    ROCs sharing a bus (e.g. two per bus on HD HexaBoards) are interleaved group by group,
+    so they progress fairly instead of contending for the adapter.
+    """
+
+    def __init__(self, rocs):
+        bus_of = lambda rname: rocs[rname].link.i2c._bus
+        self.rocs = rocs
+        self.buses = {bus: list(names) for bus, names in groupby(sorted(rocs.keys(), key=bus_of), key=bus_of)}
+
+    def run(self, tasks):
+        """
+        Execute tasks {roc_name: iterable of sortedPairs groups} by writing each group to its ROC.
+        Iterables are consumed lazily in the bus worker, so per-ROC preparation runs in parallel across buses.
+        Return {roc_name: exception} of ROCs that failed; a failing ROC does not stop the others.
+        """
+
+        failures = {}
+        workers = []
+        for bus, names in self.buses.items():
+            queue = [(rname, iter(tasks[rname])) for rname in names if rname in tasks]
+            if not queue: continue
+            worker = PropagatingThread(target=self.__worker, args=(queue, failures))
+            worker.start()
+            workers.append(worker)
+        for worker in workers: worker.join()
+        return failures
+
+    def __worker(self, queue, failures):
+        """ Round-robin one group per ROC on this bus until all tasks are exhausted or failed. """
+
+        queue = deque(queue)
+        while queue:
+            rname, groups = queue.popleft()
+            try:
+                group = next(groups)
+                self.rocs[rname].write([group])
+            except StopIteration: continue
+            except Exception as e:
+                failures[rname] = e
+                continue
+            queue.append((rname, groups))
@@ -0,0 +1,63 @@
+import numpy as np
+import yaml
+import os
+
+"""
+On-disk snapshot of the configured register state, to adopt the chips after a server restart without resetting them.
+Per ROC, a memory-mapped (2, 256, 256) uint8 array holds the written value and a written flag per (R1, R0).
+Writes only touch the changed entries in memory; the OS persists them and flush() forces it.
+"""
+
+class BoardState():
+    """ Register snapshot of all ROCs of a board in directory path (state.yaml + one <roc_name>.npy per ROC). """
+
+    def __init__(self, path, rnames):
+        self.path = path
+        self.rnames = sorted(rnames)
+        self.meta_fname = os.path.join(path, 'state.yaml')
+        self.arrays = {}
+
+    def load(self):
+        """ Return (roc_type, {roc_name: {addr: val}}) of a snapshot taken on the same ROCs, else None. """
+
+        if not os.path.exists(self.meta_fname): return None
+        with open(self.meta_fname) as f: meta = yaml.safe_load(f)
+        if not meta or meta.get('rocs') != self.rnames: return None
+        try: self.arrays = {rname: np.load(self.__fname(rname), mmap_mode='r+') for rname in self.rnames}
+        except (OSError, ValueError): return None
+        return meta['roc_type'], {rname: self.pairs(rname) for rname in self.rnames}
+
+    def create(self, roc_type):
+        """ Start an empty snapshot, e.g. after the ROCs were reset. """
+
+        os.makedirs(self.path, exist_ok=True)
+        self.arrays = {rname: np.lib.format.open_memmap(self.__fname(rname), mode='w+', dtype=np.uint8, shape=(2, 256, 256))
+                       for rname in self.rnames}
+        with open(self.meta_fname, 'w') as f:
+            yaml.dump({'roc_type': roc_type, 'rocs': self.rnames}, f, default_flow_style=False)
+
+    def pairs(self, rname):
+        """ Written addr:val pairs of a ROC. """
+
+        vals, written = self.arrays[rname]
+        r1, r0 = np.nonzero(written)
+        return {(a0, a1): val for a0, a1, val in zip(r0.tolist(), r1.tolist(), vals[r1, r0].tolist())}
+
+    def update(self, rname, pairs):
+        """ Record written addr:val pairs of a ROC. """
+
+        if not pairs: return
+        r0, r1 = np.array(list(pairs.keys()), dtype=np.int64).T
+        self.arrays[rname][0, r1, r0] = list(pairs.values())
+        self.arrays[rname][1, r1, r0] = 1
+
+    def clear(self, rname):
+        """ Forget the written registers of a ROC, e.g. after it was reset. """
+
+        self.arrays[rname][1] = 0
+
+    def flush(self):
+        for array in self.arrays.values(): array.flush()
+
+    def __fname(self, rname):
+        return os.path.join(self.path, rname + '.npy')
@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+from threading import Lock, current_thread
+import time
+
+"""
+Low-overhead instrumentation: named counters and latency/size histograms, shared by the whole process.
+Names are dotted, per-ROC quantities end in the ROC name (e.g. i2c.bytes.roc_s0_0).
+While a trace is active (see Stats.start_trace), timed spans are also recorded as a per-request profile.
+"""
+
+class Histogram():
+    """ Power-of-two buckets: bucket b counts values in [2**(b-1), 2**b), bucket 0 values below 1. """
+
+    def __init__(self):
+        self.buckets = {}
+        self.n = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, val):
+        bucket = int(val).bit_length() if val >= 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.n += 1
+        self.total += val
+        self.min = val if self.min is None else min(self.min, val)
+        self.max = val if self.max is None else max(self.max, val)
+
+    def quantile(self, q):
+        """ Upper bucket edge below which a fraction q of the values lie. """
+
+        rank, seen = q * self.n, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank: return min(2**bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {'n': self.n, 'mean': self.total/self.n if self.n else 0, 'min': self.min, 'max': self.max,
+                'p50': self.quantile(.5), 'p99': self.quantile(.99),
+                'buckets': {'<%d' % 2**b: cnt for b, cnt in sorted(self.buckets.items())}}
+
+class Stats():
+    """ Process-wide counters and histograms. Safe to update from the bus worker threads. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.trace = None       # list of span events while a profile is recorded
+            self.t0 = time.perf_counter()
+
+    def count(self, name, n=1):
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, val):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None: hist = self.histograms[name] = Histogram()
+            hist.add(val)
+
+    @contextmanager
+    def span(self, name):
+        """ Time a block into histogram name (in us), and into the profile trace if one is active. """
+
+        start = time.perf_counter()
+        try: yield
+        finally:
+            end = time.perf_counter()
+            self.observe(name, 1e6*(end - start))
+            if self.trace is not None:
+                with self.lock:
+                    if self.trace is not None:
+                        self.trace.append({'name': name, 'thread': current_thread().name,
+                                           'start_us': round(1e6*(start - self.t_trace), 1),
+                                           'dur_us': round(1e6*(end - start), 1)})
+
+    def start_trace(self):
+        with self.lock:
+            self.trace = []
+            self.t_trace = time.perf_counter()
+
+    def stop_trace(self):
+        """ End the profile and return its span events in order of completion. """
+
+        with self.lock:
+            trace, self.trace = self.trace or [], None
+        return trace
+
+    def snapshot(self):
+        with self.lock:
+            return {'uptime_s': round(time.perf_counter() - self.t0, 3),
+                    'counters': dict(self.counters),
+                    'histograms': {name: hist.summary() for name, hist in self.histograms.items()}}
+
+stats = Stats()
@@ -1,78 +1,147 @@
-import functools
-from itertools import groupby, count
-from operator import itemgetter
 from nested_dict import nested_dict
-import pickle
-import math
-
-def memoize(fn):
-    """ Readable memoize decorator. """
-
-    fn.cache = {}
-    @functools.wraps(fn)
-    def inner(inst, *key):
-        if key not in fn.cache:
-            fn.cache[key] = fn(inst, *key)
-        return fn.cache[key]
-    return inner
+from RegMap import RegMap
+from Planner import BurstPlanner
+from Stats import stats
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+import hashlib
+
+class CompiledCache():
+    """ LRU cache of compiled register deltas, keyed by a hash of the config content (incl. its order). """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def key(self, cfg):
+        return hashlib.blake2b(repr(cfg).encode(), digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            delta = self.entries.get(key)
+            if delta is not None: self.entries.move_to_end(key)
+        stats.count('translate.cache_hits' if delta is not None else 'translate.cache_misses')
+        return delta
+
+    def put(self, key, delta):
+        for array in delta: array.setflags(write=False)     # shared between requests and ROCs
+        with self.lock:
+            self.entries[key] = delta
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize: self.entries.popitem(last=False)
 
 class Translator():
     """ Translate between (human-readable) config and corresponding address/register values. """
 
     def __init__(self, roc_type):
-        if roc_type=="Si": self.paramMap = self.__load_param_map("./reg_maps/HGCROCv2_I2C_params_regmap_dict.pickle")
-        elif roc_type=="SiPM": self.paramMap = self.__load_param_map("./reg_maps/HGCROCv2_sipm_I2C_params_regmap_dict.pickle")
-        else: raise Exception("Specified ROC type unknown.")
+        self.regMap = RegMap(roc_type)
+        self.selections = {}        # (block, blockId selection, param) -> register table rows
+        self.planner = BurstPlanner()
+        self.cache = CompiledCache()    # per translator, so a new ROC type starts with an empty cache
 
     def cfg_from_pairs(self, pairs):
         """
-        Convert from {addr:val} pairs to {param:param_val} config.
-        We can only recover a parameter from a pair when it is in the common cache.
-        However, when we read (or write) a param the common cache is populated in advance.
+        Convert from {addr:val} pairs to {param:param_val} config, via the reverse address index of the map.
+        Every parameter whose registers are all contained in pairs is recovered, translated before or not.
         """
 
-        cfg = nested_dict()
-        for param, param_regs in self.__regs_from_paramMap.cache.items():
-            for reg_id, reg in param_regs.items():
-                addr = (reg["R0"], reg["R1"])
-                if addr in pairs.keys():
-                    prev_regVal = cfg[param[0]][param[1]][param[2]] if cfg[param[0]][param[1]][param[2]]!={} else 0
-                    paramVal = self.__paramVal_from_regVal(reg, pairs[addr], prev_regVal)
-                    cfg[param[0]][param[1]][param[2]] = paramVal
-        return cfg.to_dict()
-
-    def pairs_from_cfg(self, cfg, writeCache, roc):
+        pairs = {addr: val for addr, val in pairs.items() if val is not None}
+        if not pairs: return {}
+        keys = np.array([(r1 << 8) | r0 for r0, r1 in pairs.keys()], dtype=np.int64)
+        rows, owner = self.regMap.rows_at(keys)
+        regs = self.regMap.table[rows]
+        regVals = np.array(list(pairs.values()), dtype=np.int64)[owner]
+        parts = ((regVals & regs["reg_mask"]) >> regs["reg_shift"]) << regs["param_shift"]
+
+        params, inv = np.unique(self.regMap.param_ids[rows], return_inverse=True)
+        paramVals = np.zeros(len(params), dtype=np.int64)
+        np.add.at(paramVals, inv, parts)
+        complete = np.bincount(inv, minlength=len(params)) == self.regMap.param_nrows[params]
+
+        cfg = {}
+        for pid, val in zip(params[complete].tolist(), paramVals[complete].tolist()):
+            block, blockId, param = self.regMap.param_keys[pid]
+            cfg.setdefault(block, {}).setdefault(blockId, {})[param] = val
+        return cfg
+
+    def pairs_from_cfg(self, cfg, roc):
         """
         Convert an input config dict to addr (R0,R1): value (R2) pairs.
         There is two cases to consider for setting parameter value information:
         Case 1: One parameter value spans several registers. (Ex. IdleFrame)
         Case 2: Several parameter values share same register. (Ex. Delay9, Delay87)
+        Case 2 needs the previous register value, which is merged in from the ROC's shadow registers.
         """
 
+        return self.pairs_from_delta(self.compile_cfg(cfg), roc)
+
+    def pairs_from_delta(self, delta, roc):
+        """ Merge a compiled register delta (see compile_cfg) with the ROC's shadow registers into addr:val pairs. """
+
+        addrs, vals = self.merge_delta(delta, roc)
+        return {(addr & 0xff, addr >> 8): val for addr, val in zip(addrs.tolist(), vals.tolist())}
+
+    def merge_delta(self, delta, roc):
+        """ Read-modify-write merge of a compiled delta with the ROC's shadow registers: (addr keys, values) arrays. """
+
+        addrs, masks, bits = delta
+        merge = masks != 0xff                       # full registers need no previous value
+        vals = bits.copy()
+        vals[merge] |= roc.shadow_values(addrs[merge]) & ~masks[merge]
+        return addrs, vals
+
+    def compile_cfg(self, cfg):
+        """
+        Translate a whole config in one vectorized pass into a register delta:
+        sorted arrays of addr keys (R1<<8 | R0), touched-bit masks and register bits.
+        Params listed later in the config override earlier ones on shared bits (e.g. 'all' then single Ids).
+        Results are cached by config content, so a repeated config skips the translation.
+        """
+
+        key = self.cache.key(cfg)
+        delta = self.cache.get(key)
+        if delta is None:
+            delta = self.__compile_cfg(cfg)
+            self.cache.put(key, delta)
+        return delta
+
+    def __compile_cfg(self, cfg):
         cfg = self.__cut_sc(cfg)
-        pairs = {}
+        rows, paramVals = [], []
         for block in cfg:
             for blockId in cfg[block]:
                 for param, paramVal in cfg[block][blockId].items():
-                    if not isinstance(blockId, int):
-                        if blockId == "all":
-                            blockIds = [key for key,val in self.paramMap[block].items()]
-                        elif "," in blockId:
-                            blockIds = [int(bid) for bid in blockId.split(",")]
-                        elif "-" in blockId:
-                            limits = [int(bid) for bid in blockId.split("-")]
-                            blockIds = range(limits[0], limits[1]+1)
-                    else: blockIds = [blockId]
-
-                    for Id in blockIds:
-                        par_regs = self.__regs_from_paramMap(block, Id, param)
-                        for reg_id, reg in par_regs.items():
-                            addr = (reg["R0"], reg["R1"])
-                            if addr in pairs: prev_paramVal = pairs[addr]                          # regVal already added
-                            elif addr in writeCache: prev_paramVal = writeCache[addr]              # regVal already cached/written
-                            else: prev_paramVal = list(roc.read([[{addr:0}]]).values())[0]
-                            pairs[addr] = self.__regVal_from_paramVal(reg, paramVal, prev_paramVal)
-        return pairs
+                    rows.append(self.select(block, blockId, param))
+                    paramVals.append(paramVal)
+        return self.compile_rows(rows, paramVals)
+
+    def compile_rows(self, rows, paramVals):
+        """ Register delta for pre-selected register table rows (see select), one parameter value per selection. """
+
+        if not rows: return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8))
+        regs = self.regMap.table[np.concatenate(rows)]
+        paramVals = np.repeat(np.array(paramVals, dtype=np.int64), [len(sel) for sel in rows])
+        regVals = ((paramVals & regs["param_mask"]) >> regs["param_shift"]) << regs["reg_shift"]
+        regMasks = regs["reg_mask"].astype(np.int64)
+        keys = (regs["R1"].astype(np.int64) << 8) | regs["R0"]
+
+        addrs, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+        if len(addrs) == len(keys): return addrs, regMasks[first].astype(np.uint8), regVals[first].astype(np.uint8)
+
+        # Merge shared registers bit by bit: each bit is taken from the last entry touching it.
+        masks = np.zeros(len(addrs), dtype=np.int64)
+        bits = np.zeros(len(addrs), dtype=np.int64)
+        for b in range(8):
+            hit = np.flatnonzero(regMasks & (1 << b))
+            if not hit.size: continue
+            last = np.full(len(addrs), -1)
+            np.maximum.at(last, inv[hit], hit)
+            found = last >= 0
+            masks[found] |= 1 << b
+            bits[found] |= regVals[last[found]] & (1 << b)
+        return addrs, masks.astype(np.uint8), bits.astype(np.uint8)
 
     def expand_cfgs(self, cfgs, rocs):
         """ Expand ROC names & halves (if appropriate) """
@@ -90,52 +159,34 @@ class Translator():
                             res[nlbl][blk] = cfgs[lbl][blk]
         return res.to_dict()
 
-    def sort_pairs(self, pairs):
-        """ Sort pairs by same R0 and consecutive R1 """
-
-        addrs = pairs.keys()
-        addrs = sorted(addrs, key=itemgetter(0))
-        addrs = sorted(addrs, key=itemgetter(1))
-        sortedAddrs = [list(g) for k, g in groupby(addrs, key=lambda addr, c=count(): complex(addr[0]-next(c), addr[1]))]
-        sortedPairs = [[{addr: pairs[addr]} for addr in subList] for subList in sortedAddrs]
-        return sortedPairs
-
-    @memoize
-    def __regs_from_paramMap(self, block, blockId, name):
-        """ (block, blockId, name) -> (R0, R1, defval_mask, param_mask, param_minbit, reg_mask, reg_id) """
-
-        return self.paramMap[block][blockId][name]
-
-    def __load_param_map(self, fname):
-        """ Load a pickled register map into cache (as a dict). """
-
-        with open(fname, 'rb') as handle: 
-            paramMap = pickle.load(handle)
-        return paramMap
-
-    def __regVal_from_paramVal(self, reg, param_value, prev_param_value=0):
-        """ Convert parameter value (from config) into register value (1 byte). """
-
-        reg_value = param_value & reg["param_mask"]
-        reg_value >>= self.__get_lsb_id(reg["param_mask"])
-        reg_value <<= self.__get_lsb_id(reg["reg_mask"])
-        inv_mask = 0xff - reg["reg_mask"]
-        reg_value = (prev_param_value & inv_mask) + reg_value
-        return reg_value
-
-    def __paramVal_from_regVal(self, reg, reg_value, prev_reg_value=0):
-        """ Convert register value into (part of) parameter value. """
-
-        param_val = reg_value & reg["reg_mask"]
-        param_val >>= self.__get_lsb_id(reg["reg_mask"])
-        param_val <<= self.__get_lsb_id(reg["param_mask"]) 
-        param_val += prev_reg_value
-        return param_val
-
-    def __get_lsb_id(self, byte):
-        """ Return position of least significant bit of byte. """
-
-        return int(math.log(byte & -byte)/math.log(2))
+    def sort_pairs(self, pairs, roc=None):
+        """ Sort pairs into burst groups of consecutive R0 on the same R1 (see Planner.BurstPlanner). """
+
+        return self.planner.plan(pairs, roc).groups
+
+    def select(self, block, blockId, param):
+        """ (block, blockId selection, param) -> row indices in the register table, cached per translator. """
+
+        key = (block, blockId, param)
+        if key not in self.selections:
+            blockIds = self.__block_ids(block, blockId)
+            rows = []
+            for Id in blockIds:
+                start, stop = self.regMap.index[(block, Id, param)]
+                rows.append(np.arange(start, stop))
+            self.selections[key] = np.concatenate(rows)
+        return self.selections[key]
+
+    def __block_ids(self, block, blockId):
+        """ Expand 'all', 'a-b' and 'a,b,c' block IDs. """
+
+        if isinstance(blockId, int): return [blockId]
+        elif blockId == "all": return self.regMap.block_ids(block)
+        elif "," in blockId: return [int(bid) for bid in blockId.split(",")]
+        elif "-" in blockId:
+            limits = [int(bid) for bid in blockId.split("-")]
+            return range(limits[0], limits[1]+1)
+        else: return [int(blockId)]
 
     def __cut_sc(self, cfg):
         """ Allow to get rid of 'sc' inside config yaml. """
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import time
+from threading import Thread
+import zmq
+import yaml
+from Link import LinkBuilder
+import Boards
+import zmq_server
+
+"""
+Benchmarks of configure/read paths on emulated LD and HD HexaBoards (see Emulator.py).
+Every scenario reports wall time (min/median over repeats) and, where the bus is involved, the I2C
+transactions and messages per run. Results are written as JSON and can be compared to
+a previous run with --compare, e.g. before and after changes to sort_pairs, pairs_from_cfg or the link layer.
+
+Paths: 'translator' (compile + merge with the known register state, no bus access),
+       'roc'        (board calls on the emulated links),
+       'server'     (REQ round trips to a zmq_server on the emulated board).
+"""
+
+def full_cfg(translator):
+    """ Config of every parameter of every block, set to 1. """
+
+    cfg = {}
+    for (block, blockId, param) in translator.regMap.index.keys():
+        cfg.setdefault(block, {}).setdefault(blockId, {})[param] = 1
+    return {'roc_s': cfg}
+
+def step_cfg(val):
+    """ Incremental configure as sent in a pedestal DAC scan. """
+
+    return {'roc_s': {'ch': {'all': {'Ref_dac_inv': val}}}}
+
+class Bench():
+    def __init__(self, board_type, repeats, latency, msg_latency):
+        self.board_type = board_type
+        self.repeats = repeats
+        self.links = LinkBuilder.create('emu', board=board_type, latency=latency, msg_latency=msg_latency)
+        self.board = Boards.CharBoard(self.links) if board_type == 'char' else Boards.HexaBoard(self.links)
+        self.full = full_cfg(self.board.translator)
+        self.results = []
+
+    def bus_counts(self):
+        return (sum(link.i2c.transactions for link in self.links.values()),
+                sum(link.i2c.messages for link in self.links.values()))
+
+    def measure(self, scenario, path, fn, setup=None, steps=1):
+        """ Time fn() repeats times (after setup(), untimed) and record wall time and bus traffic per run. """
+
+        times, traffic = [], []
+        for _ in range(self.repeats):
+            if setup: setup()
+            tx0, msgs0 = self.bus_counts()
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+            tx1, msgs1 = self.bus_counts()
+            traffic.append((tx1 - tx0, msgs1 - msgs0))
+        res = {'board': self.board_type, 'scenario': scenario, 'path': path, 'steps': steps,
+               'wall_s_min': min(times), 'wall_s_median': statistics.median(times),
+               'transactions': traffic[-1][0], 'messages': traffic[-1][1]}
+        self.results.append(res)
+        print('[BENCH] %-3s %-10s %-22s %9.2f ms %6d transactions' %
+              (self.board_type, path, scenario, 1e3*res['wall_s_median'], res['transactions']))
+        return res
+
+    def run_translator(self):
+        translator, roc = self.board.translator, list(self.board.rocs.values())[0]
+        self.board.configure(self.full)     # shadow known, so the merge needs no bus access
+        merge = lambda cfg: translator.pairs_from_delta(translator.compile_cfg(cfg['roc_s']), roc)
+        self.measure('full_configure', 'translator', lambda: merge(self.full))
+        self.measure('scan_steps', 'translator', lambda: [merge(step_cfg(v)) for v in range(32)], steps=32)
+        self.measure('sort_pairs', 'translator', lambda: translator.sort_pairs(self.board.writeCaches[roc.name], roc))
+
+    def run_roc(self):
+        board = self.board
+        self.measure('full_configure', 'roc', lambda: board.configure(self.full), setup=board.reset)
+        self.measure('force_configure', 'roc', lambda: board.configure(self.full, force=True))
+        self.measure('scan_steps', 'roc', lambda: [board.configure(step_cfg(v)) for v in range(32)], steps=32)
+        self.measure('read_cache', 'roc', lambda: board.read(None))
+        self.measure('read_cfg', 'roc', lambda: board.read(step_cfg(0)))
+        try: self.measure('read_adc_sweep', 'roc', lambda: [board.read_adc({'roc_s': {'ReferenceVoltage': {'all': {'Calib_dac': v}}}})
+                                                             for v in range(0, 2048, 256)], steps=8)
+        except Exception as e:
+            print('[BENCH] read_adc_sweep skipped: %s' % e)
+            self.results.append({'board': self.board_type, 'scenario': 'read_adc_sweep', 'path': 'roc', 'skipped': str(e)})
+
+    def run_server(self, port):
+        server = {}
+        async def serve():
+            server['loop'], server['task'] = asyncio.get_running_loop(), asyncio.current_task()
+            try: await zmq_server.Server(self.board, port).serve()
+            except asyncio.CancelledError: pass     # stopped at the end of the benchmark
+        thread = Thread(target=asyncio.run, args=(serve(),), daemon=True)
+        thread.start()
+        context = zmq.Context()
+        socket = context.socket(zmq.REQ)
+        socket.connect('tcp://localhost:%d' % port)
+
+        def send(cmd, cfg=None):
+            socket.send_string(cmd)
+            status = socket.recv_string()
+            if status == 'READY':
+                socket.send_string(yaml.dump(cfg))
+                return socket.recv_string()
+            return status
+
+        send('status')      # wait for the server
+        self.measure('status_roundtrip', 'server', lambda: [send('status') for _ in range(100)], steps=100)
+        self.measure('full_configure', 'server', lambda: send('configure', self.full), setup=self.board.reset)
+        self.measure('scan_steps', 'server', lambda: [send('configure', step_cfg(v)) for v in range(32)], steps=32)
+        self.measure('read_cache', 'server', lambda: send('read', None))
+        socket.close(linger=0)
+        context.term()
+        server['loop'].call_soon_threadsafe(server['task'].cancel)
+        thread.join()
+
+def compare(results, baseline):
+    """ Print median wall time and transactions relative to a previous result file. """
+
+    key = lambda res: (res['board'], res['path'], res['scenario'])
+    base = {key(res): res for res in baseline['results'] if 'skipped' not in res}
+    for res in results['results']:
+        old = base.get(key(res))
+        if 'skipped' in res or not old: continue
+        print('%-3s %-10s %-22s time x%.2f  transactions %d -> %d' % (key(res) + (res['wall_s_median']/old['wall_s_median'],
+              old['transactions'], res['transactions'])))
+
+def revision():
+    try: return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser()
+
+    parser.add_option("-b", "--boards", default="ld,hd",
+                      action="store", dest="boards",
+                      help="comma-separated emulated board types (char, ld, hd)")
+
+    parser.add_option("-n", "--repeats", default=5,
+                      action="store", dest="repeats", type=int,
+                      help="runs per scenario")
+
+    parser.add_option("-l", "--latency", default=0.,
+                      action="store", dest="latency", type=float,
+                      help="emulated latency per I2C transaction [s]")
+
+    parser.add_option("-m", "--msgLatency", default=0.,
+                      action="store", dest="msgLatency", type=float,
+                      help="emulated latency per I2C message [s]")
+
+    parser.add_option("-p", "--paths", default="translator,roc,server",
+                      action="store", dest="paths",
+                      help="comma-separated benchmark paths")
+
+    parser.add_option("-o", "--output", default="benchmark.json",
+                      action="store", dest="output",
+                      help="JSON results file")
+
+    parser.add_option("-c", "--compare", default=None,
+                      action="store", dest="compare",
+                      help="JSON results of a previous run to compare with")
+
+    parser.add_option("--port", default=5599,
+                      action="store", dest="port", type=int,
+                      help="port of the benchmark server")
+
+    (options, args) = parser.parse_args()
+
+    results = {'revision': revision(), 'python': platform.python_version(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'repeats': options.repeats, 'latency': options.latency, 'msg_latency': options.msgLatency, 'results': []}
+    paths = options.paths.split(',')
+    for idx, board_type in enumerate(options.boards.split(',')):
+        bench = Bench(board_type, options.repeats, options.latency, options.msgLatency)
+        if 'translator' in paths: bench.run_translator()
+        if 'roc' in paths: bench.run_roc()
+        if 'server' in paths: bench.run_server(options.port + idx)
+        results['results'] += bench.results
+
+    with open(options.output, 'w') as f: json.dump(results, f, indent=1)
+    print('[BENCH] Results written to %s' % options.output)
+    if options.compare:
+        with open(options.compare) as f: compare(results, json.load(f))
@@ -0,0 +1,259 @@
+import zmq
+import zmq.asyncio
+import asyncio
+import time
+import sys
+import yaml
+from Protocol import Codec
+
+"""
+ZMQ-Orchestrator: drive many controller boards concurrently with the asynchronous (DEALER) server protocol.
+Every board has its own non-blocking socket; a command is fanned out to all boards at once, with a timeout
+and retries per board, and the answers are aggregated into one report.
+
+Library use (sockets are created in the running event loop, on the first run):
+    async def configure(cfg):
+        fleet = Fleet({'board1': 'tcp://192.168.1.10:5555', 'board2': 'tcp://192.168.1.11:5555'})
+        try: return await fleet.run('configure', cfg)
+        finally: fleet.close()
+    report = asyncio.run(configure(cfg))
+"""
+
+class RequestError(Exception):
+    """ The server answered a request with ERROR. """
+
+class BoardClient():
+    """ Asynchronous client of one zmq_server, with any number of requests in flight. """
+
+    def __init__(self, name, address, protocol='yaml'):
+        self.name = name
+        self.address = address
+        self.context = None
+        self.protocol = Codec(protocol)     # fails early on an unknown or unavailable encoding
+        self.codec = Codec('yaml')
+        self.socket = None
+
+    def connect(self, context):
+        self.context = context
+        self.codec = Codec('yaml')      # a new connection starts with the server default
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+        self.unassigned = []    # futures of sent requests waiting for their job id, in send order
+        self.jobs = {}          # job id -> (future, progress callback, raw answer, queued callback)
+        self.receiver = asyncio.ensure_future(self.__receive())
+
+    def close(self):
+        if self.socket is None: return
+        self.receiver.cancel()
+        for future, *_ in self.jobs.values(): future.cancel()
+        for future, *_ in self.unassigned: future.cancel()
+        self.socket.close()
+        self.socket = None
+
+    def reconnect(self):
+        """ Drop a connection in unknown state (e.g. after a timeout) and start over. """
+
+        self.close()
+        self.connect(self.context)
+
+    async def negotiate(self):
+        """ Switch the payload encoding of the connection to self.protocol, once. """
+
+        if self.codec.name == self.protocol.name: return
+        await self.request('protocol', self.protocol.name, raw=True)
+        self.codec = self.protocol
+
+    async def request(self, cmd, cfg=None, progress=None, raw=False, queued=None):
+        """
+        Send cmd with cfg and return the answer; progress(partial answer) is called for streaming commands
+        and queued() once the server has accepted the request.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.unassigned.append((future, progress, raw, queued))
+        data = cfg.encode() if raw else (self.codec.dumps(cfg) if cfg is not None else b'')
+        await self.socket.send_multipart([b'', cmd.encode(), data])
+        return await future
+
+    async def __receive(self):
+        """ Match server messages [b'', status, id, payload] to the requests in flight. """
+
+        while True:
+            frames = await self.socket.recv_multipart()
+            status, jid, payload = frames[1].decode(), frames[2].decode(), frames[3] if len(frames) > 3 else b''
+            if jid not in self.jobs:
+                if not self.unassigned: continue        # late answer of a dropped request
+                self.jobs[jid] = self.unassigned.pop(0)
+            future, progress, raw, queued = self.jobs[jid]
+            if status == 'QUEUED':
+                if queued: queued()
+                continue
+            if status == 'PROGRESS':
+                if progress: progress(self.codec.loads(payload))
+                continue
+            del self.jobs[jid]
+            if future.done(): continue
+            if status == 'DONE': future.set_result(payload.decode() if raw else self.codec.loads(payload))
+            else: future.set_exception(RequestError(payload.decode()))
+
+class Fleet():
+    """
+    A set of boards {name: address}, commanded concurrently.
+    A board's request is retried up to retries times after a timeout (and, with retry_errors, after an ERROR
+    answer); failures of one board never hold up the others. A timed-out command that changes the board state
+    is only resent if the server never queued it, since it may still be running.
+    """
+
+    read_only = {'read', 'read_regs', 'read_pwr', 'monitor', 'status', 'stats'}    # safe to run twice
+
+    def __init__(self, boards, protocol='yaml', timeout=60., retries=2, retry_errors=False, max_parallel=None, verbose=True):
+        self.clients = {name: BoardClient(name, address, protocol) for name, address in boards.items()}
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_errors = retry_errors
+        self.max_parallel = max_parallel
+        self.verbose = verbose
+        self.context = None
+        self.limit = None
+
+    def connect(self):
+        """ Create the context and sockets; called by run in the running event loop. """
+
+        self.context = zmq.asyncio.Context()
+        self.limit = asyncio.Semaphore(self.max_parallel) if self.max_parallel else None
+        for client in self.clients.values(): client.connect(self.context)
+
+    def close(self):
+        for client in self.clients.values(): client.close()
+        if self.context: self.context.term()
+        self.context = None
+
+    async def run(self, cmd, cfg=None, cfgs=None, progress=None, names=None):
+        """
+        Run cmd on all boards (or the boards names), with the same cfg or per-board cfgs {name: cfg}.
+        progress(name, partial answer) receives streamed results. Return the aggregated report.
+        """
+
+        if self.context is None: self.connect()
+        start = time.perf_counter()
+        names = list(self.clients.keys()) if names is None else list(names)
+        results = await asyncio.gather(*[self.__run_board(self.clients[name], cmd, (cfgs or {}).get(name, cfg), progress)
+                                         for name in names])
+        report = {'command': cmd, 'boards': len(names), 'elapsed_s': round(time.perf_counter() - start, 3),
+                  'results': dict(zip(names, results))}
+        report['ok'] = sum(res['ok'] for res in results)
+        report['failed'] = sorted(name for name, res in report['results'].items() if not res['ok'])
+        return report
+
+    async def run_sequence(self, steps, progress=None):
+        """ Run [(cmd, cfg)] steps one after another on all boards. Boards failing a step skip the remaining steps. """
+
+        reports, active = [], list(self.clients.keys())
+        for cmd, cfg in steps:
+            report = await self.run(cmd, cfg, progress=progress, names=active)
+            reports.append(report)
+            active = [name for name in active if report['results'][name]['ok']]
+        return reports
+
+    async def __run_board(self, client, cmd, cfg, progress):
+        start = time.perf_counter()
+        res = {'ok': False, 'attempts': 0, 'progress': 0}
+        def on_progress(partial):
+            res['progress'] += 1
+            if progress: progress(client.name, partial)
+
+        for attempt in range(self.retries + 1):
+            res['attempts'] = attempt + 1
+            queued = []
+            try:
+                if self.limit: await self.limit.acquire()
+                try: res['answer'] = await asyncio.wait_for(self.__request(client, cmd, cfg, on_progress, lambda: queued.append(True)),
+                                                            self.timeout)
+                finally:
+                    if self.limit: self.limit.release()
+                res['ok'] = True
+                res.pop('error', None)
+                break
+            except asyncio.TimeoutError:
+                res['error'] = 'timeout after %gs' % self.timeout
+                client.reconnect()
+                if queued and cmd not in self.read_only:
+                    res['error'] += ', queued on the board and not resent'
+                    break
+            except RequestError as e:
+                res['error'] = str(e)
+                if not self.retry_errors: break
+            if self.verbose: print('[%s] %s failed (%s), attempt %d/%d' % (client.name, cmd, res['error'], attempt + 1, self.retries + 1))
+
+        res['elapsed_s'] = round(time.perf_counter() - start, 3)
+        if self.verbose: print('[%s] %s %s in %.3fs' % (client.name, cmd, 'DONE' if res['ok'] else 'FAILED', res['elapsed_s']))
+        return res
+
+    async def __request(self, client, cmd, cfg, progress, queued):
+        await client.negotiate()
+        return await client.request(cmd, cfg, progress, queued=queued)
+
+def load_boards(fname=None, addresses=None):
+    """ Boards {name: address} from a yaml file ({name: address} or [address]) and/or comma-separated addresses. """
+
+    boards = {}
+    if fname:
+        with open(fname) as f: entries = yaml.safe_load(f)
+        boards.update(entries if isinstance(entries, dict) else {addr: addr for addr in entries})
+    if addresses: boards.update({addr: addr for addr in addresses.split(',')})
+    return boards
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options] command")
+
+    parser.add_option("-b", "--boards", default=None,
+                      action="store", dest="boards",
+                      help="yaml file with boards {name: tcp://host:port} or a list of addresses")
+
+    parser.add_option("-a", "--addresses", default=None,
+                      action="store", dest="addresses",
+                      help="comma-separated board addresses, e.g. tcp://hexactrl1:5555,tcp://hexactrl2:5555")
+
+    parser.add_option("-f", "--configFile", default=None,
+                      action="store", dest="configFile",
+                      help="yaml config (or scan spec) sent with the command")
+
+    parser.add_option("-t", "--timeout", default=60., type=float,
+                      action="store", dest="timeout",
+                      help="seconds to wait for a board's answer")
+
+    parser.add_option("-r", "--retries", default=2, type=int,
+                      action="store", dest="retries",
+                      help="retries per board after a timeout (commands changing the board only if not queued yet)")
+
+    parser.add_option("-p", "--protocol", default="yaml",
+                      action="store", dest="protocol",
+                      help="payload encoding, e.g. msgpack+zlib")
+
+    parser.add_option("-o", "--output", default=None,
+                      action="store", dest="output",
+                      help="write the report to this yaml file")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1: parser.error('expected exactly one command, e.g. configure')
+
+    boards = load_boards(options.boards, options.addresses)
+    if not boards: parser.error('no boards given (-b or -a)')
+    cfg = None
+    if options.configFile:
+        with open(options.configFile) as f: cfg = yaml.safe_load(f)
+
+    fleet = Fleet(boards, options.protocol, options.timeout, options.retries)
+    progress = lambda name, partial: print('[%s] PROGRESS %s' % (name, partial.get('step', partial) if isinstance(partial, dict) else partial))
+    async def run():
+        try: return await fleet.run(args[0], cfg, progress=progress)
+        finally: fleet.close()
+    report = asyncio.run(run())
+
+    print('[FLEET] %s: %d/%d boards OK in %.3fs%s' % (report['command'], report['ok'], report['boards'], report['elapsed_s'],
+          ', failed: %s' % ', '.join(report['failed']) if report['failed'] else ''))
+    if options.output:
+        with open(options.output, 'w') as f: yaml.dump(report, f, default_flow_style=False)
+    sys.exit(1 if report['failed'] else 0)
@@ -1,53 +1,301 @@
 import zmq
-import yaml
+import zmq.asyncio
+import asyncio
+import time
+import json
 from Link import LinkBuilder
+from Protocol import Codec, pack_regs, unpack_regs
+from Stats import stats
+from Monitor import Monitor
 import Boards
 
-""" ZMQ-Server: Redirect user request to Board. """
+"""
+ZMQ-Server: Redirect user requests to Board.
 
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.bind("tcp://*:5555")
-print('[ZMQ] Server started')
+Requests are queued per board resource ('i2c' for chip I/O, 'monitor' for Trophy ADC reads),
+so monitoring keeps running while a configuration is in progress. Two client protocols are served:
+- REQ clients (zmq_client.py): send cmd; if the server answers 'READY', send the cfg; receive the answer.
+- DEALER clients (async): send [b'', cmd, cfg] and receive [b'', b'QUEUED', id] right away,
+  then [b'', b'DONE', id, answer] or [b'', b'ERROR', id, message] once the request has run.
+  Streaming commands (scan) send [b'', b'PROGRESS', id, step result] in between.
+Payloads are YAML unless the connection negotiates another encoding with the 'protocol' command
+(cfg e.g. 'msgpack' or 'msgpack+zlib'). Status strings (READY, E: ...) are always plain text.
+Register-level commands write_regs/read_regs carry {roc_name: packed (R0, R1, val) bytes}.
+'stats' answers counters and histograms right away (DEALER cfg {'reset': True} clears them afterwards);
+'profile' runs {'cmd': cmd, 'cfg': cfg} and answers {'answer': ..., 'trace': [timed spans]}.
+With a background Monitor, 'monitor' answers windowed ADC aggregates (cfg {'window': s, 'channels': [...]})
+and read_pwr the latest sample, without touching the ADCs on the request path.
+"""
 
-def redirect(fn):
-    socket.send_string('READY')
-    cfg_str  = socket.recv_string()
-    cfg_yaml = yaml.safe_load(cfg_str)
-    ans_yaml = fn(cfg_yaml)
-    ans_str  = yaml.dump(ans_yaml, default_flow_style=False)
-    socket.send_string(ans_str)
+class Job():
+    """ One queued request. """
 
-try:
+    def __init__(self, jid, cmd, fn, cfg, reply, progress=None):
+        self.id = jid
+        self.cmd = cmd
+        self.fn = fn
+        self.cfg = cfg
+        self.reply = reply      # coroutine function (ok, answer) to deliver the result
+        self.progress = progress    # thread-safe function (partial result) for streaming commands
+        self.t_queued = time.perf_counter()
 
-    links = LinkBuilder.create(sc_type='xil')
-    if len(links) == 1: board = Boards.CharBoard(links)
-    if len(links) >= 3: board = Boards.HexaBoard(links)
+class Server():
+    """ Asynchronous ROUTER server with one job queue per board resource. """
 
-    while True:
-        string = socket.recv_string().lower()
+    def __init__(self, board, port=5555, stats_interval=None, monitor=None):
+        self.board = board
+        self.monitor = monitor      # background ADC Monitor, started with serve()
+        self.stats_interval = stats_interval     # seconds between structured stats log lines, None: off
+        self.port = port
+        self.context = None     # context, socket and queues belong to the event loop running serve()
+        self.socket = None
+        self.queues = {}
+        self.latency = {}       # cmd -> [count, total_s, max_s]
+        self.pending = {}       # REQ client identity -> cmd waiting for its cfg
+        self.codecs = {}        # client identity -> negotiated Codec (default YAML)
+        self.default_codec = Codec('yaml')
+        self.next_id = 0
+        self.commands = self.__commands(board)
+        self.streaming = {'scan'}  # commands taking a progress callback
 
-        if string == "initialize" or string == "configure":
-            if board: redirect(board.configure)
-            else: socket.send_string("E: Board not initialized.")
+    def __commands(self, board):
+        """ cmd -> (resource, function(cfg), needs cfg) """
 
-        elif string == "read": redirect(board.read)
+        hexa = type(board) is Boards.HexaBoard
+        no_adc = lambda cfg: 'E: ADCs exist only on Trophy/Hexaboard.'
+        read_pwr = lambda cfg: board.read_pwr()
+        if self.monitor: read_pwr = lambda cfg: self.monitor.latest(['piv_a', 'piv_d'])
+        commands = {
+            'initialize':      ('i2c', board.configure, True),
+            'configure':       ('i2c', board.configure, True),
+            'force_configure': ('i2c', lambda cfg: board.configure(cfg, force=True), True),   # rewrite all registers, e.g. for recovery
+            'read':            ('i2c', board.read, True),
+            'reset_tdc':       ('i2c', lambda cfg: board.reset_tdc(), False),
+            'read_adc':        ('i2c', board.read_adc if hexa else no_adc, hexa),
+            'read_pwr':        ('monitor', read_pwr if hexa else no_adc, False),
+            'monitor':         ('monitor', self.monitor.query if self.monitor else lambda cfg: 'E: Monitor not running.', True),
+            'write_regs':      ('i2c', lambda cfg: board.write_regs({r: unpack_regs(d) for r, d in cfg.items()}), True),
+            'read_regs':       ('i2c', lambda cfg: {r: pack_regs(p) for r, p in
+                                    board.read_regs({r: unpack_regs(d) for r, d in (cfg or {}).items()}).items()}, True),
+            'scan':            ('i2c', board.scan, True),
+            'profile':         ('i2c', self.__profile, True),
+        }
+        commands['resettdc'] = commands['reset_tdc']
+        commands['measadc'] = commands['read_adc']
+        return commands
 
-        elif string == "reset_tdc" or string == "resettdc":
-            ans = board.reset_tdc()
-            socket.send_string('%s' % ans)
+    def status(self):
+        """ Queue depth per resource, per-command latency (queued to answered) and I2C retries per ROC. """
 
-        elif string == "read_adc" or string == "measadc":
-            if type(board) is Boards.HexaBoard: redirect(board.read_adc)
-            else: socket.send_string('E: ADCs exist only on Trophy/Hexaboard.')
+        return {'queues': {res: queue.qsize() for res, queue in self.queues.items()},
+                'latency_ms': {cmd: {'n': n, 'mean': 1e3*tot/n, 'max': 1e3*tmax}
+                               for cmd, (n, tot, tmax) in self.latency.items()},
+                'retries': self.board.retry_stats()}
 
-        elif string == "read_pwr":
-            if type(board) is Boards.HexaBoard:
-                pwr = board.read_pwr()
-                socket.send_string("%s" % yaml.dump(pwr, default_flow_style=False))
-            else: socket.send_string('E: ADCs exist only on Trophy/Hexaboard.')
+    def report_stats(self, cfg=None):
+        """ Snapshot of the instrumentation counters and histograms, optionally resetting them. """
 
-except KeyboardInterrupt:
-    print('\nClosing server.')
-    socket.close()
-    context.term()
+        snapshot = stats.snapshot()
+        if cfg and cfg.get('reset'): stats.reset()
+        return snapshot
+
+    def __profile(self, cfg):
+        """ Run one command while recording a trace of its timed spans. """
+
+        if cfg.get('cmd') not in self.commands or cfg['cmd'] == 'profile': raise ValueError('Cannot profile %s.' % cfg.get('cmd'))
+        _, fn, _ = self.commands[cfg['cmd']]
+        stats.start_trace()
+        try: ans = fn(cfg.get('cfg'))
+        finally: trace = stats.stop_trace()
+        return {'answer': ans, 'trace': trace}
+
+    async def serve(self):
+        self.context = zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind("tcp://*:%d" % self.port)
+        self.queues = {'i2c': asyncio.Queue(), 'monitor': asyncio.Queue()}
+        workers = [asyncio.ensure_future(self.__worker(queue)) for queue in self.queues.values()]
+        if self.stats_interval: workers.append(asyncio.ensure_future(self.__log_stats()))
+        if self.monitor: self.monitor.start()
+        print('[ZMQ] Server started')
+        try:
+            while True:
+                frames = await self.socket.recv_multipart()
+                if len(frames) not in (3, 4) or frames[1] != b'':    # frames[1] is the empty delimiter
+                    print('[ZMQ] Dropped malformed message of %d frame(s)' % len(frames))
+                    continue
+                ident, msg = frames[0], frames[2:]
+                try:
+                    if len(msg) == 1: await self.__handle_req(ident, msg[0])
+                    else: await self.__handle_async(ident, msg[0].decode(errors='replace'), msg[1])
+                except Exception as e:      # never let one bad request stop the server
+                    print('[ZMQ] ERROR handling request: %r' % e)
+                    if len(msg) == 1:
+                        self.pending.pop(ident, None)
+                        await self.__send(ident, 'E: %s' % e)
+                    else: await self.__send(ident, 'ERROR', '', str(e))
+        finally:
+            for worker in workers: worker.cancel()
+            self.close()
+
+    async def __handle_req(self, ident, data):
+        """ REQ protocol: cmd, optional READY/cfg handshake, single answer. """
+
+        async def reply(ok, ans):
+            await self.__send(ident, self.__encode(ident, ans) if ok else 'E: %s' % ans)
+
+        if ident in self.pending:                       # second step of handshake: data is the cfg
+            cmd = self.pending.pop(ident)
+            if cmd == 'protocol':                       # answered in plain text
+                ok, ans = self.__negotiate(ident, data.decode(errors='replace'))
+                return await self.__send(ident, ans if ok else 'E: %s' % ans)
+            try: cfg = self.__codec(ident).loads(data)
+            except Exception as e: return await reply(False, 'Cannot decode cfg: %s' % e)
+            return await self.__submit(cmd, cfg, reply)
+
+        try: cmd = data.decode().lower()
+        except UnicodeDecodeError: return await reply(False, 'Cannot decode command.')
+        if cmd in ('status', 'stats'): return await self.__inline(cmd, None, reply)
+        if cmd == 'protocol':
+            self.pending[ident] = cmd
+            return await self.__send(ident, 'READY')
+        if cmd not in self.commands: return await reply(False, 'Unknown command %s.' % cmd)
+        if self.commands[cmd][2]:
+            self.pending[ident] = cmd
+            return await self.__send(ident, 'READY')
+        await self.__submit(cmd, None, reply)
+
+    async def __handle_async(self, ident, cmd, data):
+        """ DEALER protocol: [cmd, cfg] -> QUEUED id, later DONE/ERROR id answer. """
+
+        cmd = cmd.lower()
+        jid = str(self.next_id)
+        self.next_id += 1
+
+        async def reply(ok, ans):
+            if ok: await self.__send(ident, 'DONE', jid, self.__encode(ident, ans))
+            else: await self.__send(ident, 'ERROR', jid, str(ans))
+
+        if cmd == 'protocol':
+            ok, ans = self.__negotiate(ident, data.decode(errors='replace'))
+            return await self.__send(ident, 'DONE' if ok else 'ERROR', jid, ans)
+        if cmd not in self.commands and cmd not in ('status', 'stats'):
+            return await self.__send(ident, 'ERROR', jid, 'Unknown command %s.' % cmd)
+        try: cfg = self.__codec(ident).loads(data)
+        except Exception as e: return await self.__send(ident, 'ERROR', jid, 'Cannot decode cfg: %s' % e)
+        await self.__send(ident, 'QUEUED', jid)
+        if cmd in ('status', 'stats'): return await self.__inline(cmd, cfg, reply)
+
+        progress = None
+        if cmd in self.streaming:
+            loop = asyncio.get_running_loop()
+            progress = lambda res: asyncio.run_coroutine_threadsafe(
+                self.__send(ident, 'PROGRESS', jid, self.__encode(ident, res)), loop)
+        await self.__submit(cmd, cfg, reply, jid, progress)
+
+    async def __inline(self, cmd, cfg, reply):
+        """ Answer status/stats on the event loop, replying ERROR instead of raising. """
+
+        try: ans = self.status() if cmd == 'status' else self.report_stats(cfg)
+        except Exception as e:
+            print('[ZMQ] ERROR in %s: %s' % (cmd, e))
+            return await reply(False, e)
+        await reply(True, ans)
+
+    async def __submit(self, cmd, cfg, reply, jid=None, progress=None):
+        resource, fn, _ = self.commands[cmd]
+        await self.queues[resource].put(Job(jid, cmd, fn, cfg, reply, progress))
+
+    async def __worker(self, queue):
+        """ Run jobs of one resource one after another in a thread, so the event loop keeps serving. """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await queue.get()
+            try:
+                if job.progress: ans = await loop.run_in_executor(None, job.fn, job.cfg, job.progress)
+                else: ans = await loop.run_in_executor(None, job.fn, job.cfg)
+                ok = True
+            except Exception as e:
+                print('[ZMQ] ERROR in %s: %s' % (job.cmd, e))
+                ans, ok = e, False
+            dt = time.perf_counter() - job.t_queued
+            n, tot, tmax = self.latency.get(job.cmd, (0, 0., 0.))
+            self.latency[job.cmd] = (n+1, tot+dt, max(tmax, dt))
+            stats.observe('zmq.latency_us.' + job.cmd, 1e6*dt)
+            if not ok: stats.count('zmq.errors.' + job.cmd)
+            await job.reply(ok, ans)
+
+    async def __log_stats(self):
+        """ Print a structured (JSON) stats line every stats_interval seconds. """
+
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            print('[STATS] %s' % json.dumps(stats.snapshot()))
+
+    async def __send(self, ident, *frames):
+        await self.socket.send_multipart([ident, b''] + [f if isinstance(f, bytes) else f.encode() for f in frames])
+
+    def __negotiate(self, ident, name):
+        """ Switch the payload encoding of a client connection. """
+
+        try: self.codecs[ident] = Codec(name)
+        except ValueError as e: return False, str(e)
+        return True, 'PROTOCOL %s' % self.codecs[ident].name
+
+    def __codec(self, ident):
+        return self.codecs.get(ident, self.default_codec)
+
+    def __encode(self, ident, ans):
+        return self.__codec(ident).dumps(ans)
+
+    def close(self):
+        if self.monitor: self.monitor.stop()
+        if self.socket is None: return
+        self.socket.close(linger=0)
+        self.context.term()
+        self.socket = self.context = None
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser()
+
+    parser.add_option("-p", "--port",
+                      action="store", dest="port", type=int, default=5555,
+                      help="port to listen on")
+
+    parser.add_option("-s", "--statsInterval",
+                      action="store", dest="statsInterval", type=float, default=None,
+                      help="print stats as JSON every statsInterval seconds")
+
+    parser.add_option("-e", "--emulate",
+                      action="store", dest="emulate", default=None,
+                      help="serve an emulated char, ld or hd board instead of the hardware")
+
+    parser.add_option("-w", "--stateDir",
+                      action="store", dest="stateDir", default=None,
+                      help="keep a register snapshot in stateDir and adopt the chips from it on restart")
+
+    parser.add_option("-m", "--monitorRate",
+                      action="store", dest="monitorRate", type=float, default=0,
+                      help="sample the Trophy ADCs in the background at monitorRate Hz (HexaBoard)")
+
+    parser.add_option("--monitorPort",
+                      action="store", dest="monitorPort", type=int, default=5556,
+                      help="port publishing the monitor samples")
+
+    (options, args) = parser.parse_args()
+
+    if options.emulate: links = LinkBuilder.create(sc_type='emu', board=options.emulate)
+    else: links = LinkBuilder.create(sc_type='xil')
+    if len(links) == 1: board = Boards.CharBoard(links, options.stateDir)
+    if len(links) >= 3: board = Boards.HexaBoard(links, options.stateDir)
+
+    monitor = None
+    if options.monitorRate and type(board) is Boards.HexaBoard:
+        monitor = Monitor(board.monitor_adcs(), options.monitorRate, port=options.monitorPort)
+    server = Server(board, options.port, options.statsInterval, monitor)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print('\nClosing server.')